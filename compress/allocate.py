@@ -0,0 +1,294 @@
+#############################################################################
+# Rank allocation for low-rank compression (see compress.py)
+#   Chooses ranks of all conv & FC layers under a global budget of
+#   multiply-accumulate operations (MACs), maximizing the product of
+#   per-layer PCA energies retained (sum of log-energies)
+#
+# Contents
+#   1. Layer spectra
+#   2. Greedy rank allocator
+#   3. Compressed prototxt writer
+#   4. Main module
+#############################################################################
+
+import heapq
+import numpy as np
+
+
+
+#############################################################################
+# 1. Layer spectra
+#############################################################################
+
+# Cumulative energy ratios of a weight matrix (C' x C x kh x kw  or  D' x D)
+#   energy[r-1] = (sum of top-r squared singular values) / (total)
+#   Squared singular values are eigenvalues of W * W' along smaller dimension
+def EnergySpectrum(W):
+    W_2d = np.asarray(W, dtype=np.float32).reshape((W.shape[0], -1))
+    if W_2d.shape[0] > W_2d.shape[1]:
+        W_2d = W_2d.T
+    D = np.linalg.eigvalsh(np.dot(W_2d, W_2d.T).astype(np.double))
+    D = np.maximum(D[::-1], 0)
+    return np.cumsum(D) / max(D.sum(), np.finfo(np.double).tiny)
+
+
+# Layer descriptors for rank allocation
+#   name, type ('conv' or 'fc'), energy (see EnergySpectrum),
+#   in_dim (C * kh * kw  or  D), out_dim (C'  or  D'),
+#   positions (number of output pixels per forward pass, or number of
+#   inputs for FC, e.g., RoIs)
+#   MACs of original layer = out_dim * in_dim * positions
+#   MACs of rank-R layer = R * (in_dim + out_dim) * positions
+def LayerInfo(name, layer_type, W, positions=1):
+    return {
+        'name': name,
+        'type': layer_type,
+        'energy': EnergySpectrum(W),
+        'in_dim': int(np.prod(W.shape[1:])),
+        'out_dim': int(W.shape[0]),
+        'positions': int(positions),
+    }
+
+
+# Layer descriptors of all conv & FC layers in a caffe network
+#   Output sizes are taken from net's blobs, i.e., net's input size
+#   fc_positions: number of FC layer inputs per forward pass, e.g., number
+#                 of RoIs in Faster R-CNN (default: batch size of FC blobs)
+#   Grouped convolutions are skipped
+def CollectLayers(net, layer_names=None, fc_positions=None):
+    layers = []
+    for name, layer in zip(net._layer_names, net.layers):
+        if layer_names is not None and name not in layer_names:
+            continue
+        if layer.type not in ['Convolution', 'InnerProduct']:
+            continue
+        W = net.params[name][0].data
+        if layer.type == 'Convolution':
+            bottom_shape = net.blobs[net.bottom_names[name][0]].data.shape
+            if bottom_shape[1] != W.shape[1]:
+                continue
+            top_shape = net.blobs[net.top_names[name][0]].data.shape
+            positions = np.prod(top_shape) / W.shape[0]
+            layers.append(LayerInfo(name, 'conv', W, positions))
+        else:
+            positions = fc_positions
+            if positions is None:
+                positions = net.blobs[net.top_names[name][0]].data.shape[0]
+            layers.append(LayerInfo(name, 'fc', W, positions))
+    return layers
+
+
+
+#############################################################################
+# 2. Greedy rank allocator
+#############################################################################
+
+# MACs of a layer for given rank (None: original layer)
+def LayerMACs(layer, rank):
+    if rank is None:
+        return layer['out_dim'] * layer['in_dim'] * layer['positions']
+    return rank * (layer['in_dim'] + layer['out_dim']) * layer['positions']
+
+
+# Retained energy of a layer for given rank (None: original layer)
+def LayerEnergy(layer, rank):
+    if rank is None:
+        return 1.0
+    return layer['energy'][rank - 1]
+
+
+# Choose ranks such that total MACs of layers <= budget
+#   budget: number of MACs, or ratio to original MACs if <= 1
+#   Each layer starts from its original form, then goes to the largest
+#   rank cheaper than the original, and then loses one rank at a time.
+#   At each step, the layer losing least log-energy per saved MAC is
+#   chosen, until the budget is met.
+#   Returns dict: layer name -> rank (None: not compressed)
+def AllocateRanks(layers, budget, min_rank=1):
+    if budget <= 1:
+        budget = budget * sum([LayerMACs(layer, None) for layer in layers])
+
+    def NextStep(layer, rank):
+        # (loss of log-energy per saved MAC, next rank), or None
+        if rank is None:
+            in_dim, out_dim = layer['in_dim'], layer['out_dim']
+            next_rank = min((out_dim * in_dim - 1) / (in_dim + out_dim),
+                            len(layer['energy']))
+        else:
+            next_rank = rank - 1
+        if next_rank < min_rank:
+            return None
+        saving = LayerMACs(layer, rank) - LayerMACs(layer, next_rank)
+        loss = np.log(LayerEnergy(layer, rank)) \
+               - np.log(max(LayerEnergy(layer, next_rank), np.finfo(np.double).tiny))
+        return (loss / saving, next_rank)
+
+    ranks = dict([(layer['name'], None) for layer in layers])
+    total = sum([LayerMACs(layer, None) for layer in layers])
+    heap = []
+    for i, layer in enumerate(layers):
+        step = NextStep(layer, None)
+        if step is not None:
+            heapq.heappush(heap, (step[0], i, step[1]))
+
+    while total > budget and len(heap) > 0:
+        score, i, next_rank = heapq.heappop(heap)
+        layer = layers[i]
+        total -= LayerMACs(layer, ranks[layer['name']]) - LayerMACs(layer, next_rank)
+        ranks[layer['name']] = next_rank
+        step = NextStep(layer, next_rank)
+        if step is not None:
+            heapq.heappush(heap, (step[0], i, step[1]))
+
+    if total > budget:
+        print '[ERROR] Cannot meet budget %d MACs (minimum %d MACs)' % (budget, total)
+    return ranks
+
+
+# cfgs['layers'] for compress.Compression: [(layer name, rank)] in
+# network order, for compressed layers only
+#   Compression dispatches on layer type, so any conv & FC layer names
+#   (e.g., rpn_cls_score, cls_score) can be given
+def RankConfig(layers, ranks):
+    return [(layer['name'], ranks[layer['name']]) for layer in layers \
+            if ranks[layer['name']] is not None]
+
+
+def ShowRanks(layers, ranks):
+    total_before = 0
+    total_after = 0
+    log_energy = 0.0
+    for layer in layers:
+        rank = ranks[layer['name']]
+        before = LayerMACs(layer, None)
+        after = LayerMACs(layer, rank)
+        total_before += before
+        total_after += after
+        log_energy += np.log(LayerEnergy(layer, rank))
+        print '  %-24s %5s  energy %.4f  %9.2fM -> %9.2fM MACs' \
+              % (layer['name'], 'full' if rank is None else str(rank), \
+                 LayerEnergy(layer, rank), before / 1e6, after / 1e6)
+    print 'Total: %.2fM -> %.2fM MACs (%.1f%%), energy product %.4f' \
+          % (total_before / 1e6, total_after / 1e6, \
+             100.0 * total_after / max(total_before, 1), np.exp(log_energy))
+
+
+
+#############################################################################
+# 3. Compressed prototxt writer
+#############################################################################
+
+# Replace each compressed layer (caffe_pb2.LayerParameter) by two layers,
+# same as ./prototxt/compressed.prototxt
+#   {layer}_a: same kernel as original, rank outputs
+#   {layer}_b: 1 x 1 conv (or FC) from rank to original outputs,
+#              writing to the original top, so later layers are unchanged
+#   postfix: names of the two layers, e.g., ('_L', '_U') for dl.compress_fc
+def CompressedProto(proto, ranks, postfix=('_a', '_b')):
+    compressed = type(proto)()
+    compressed.CopyFrom(proto)
+    del compressed.layer[:]
+    for layer in proto.layer:
+        if ranks.get(layer.name) is None:
+            compressed.layer.add().CopyFrom(layer)
+            continue
+        layer_a = compressed.layer.add()
+        layer_a.CopyFrom(layer)
+        layer_a.name = layer.name + postfix[0]
+        del layer_a.top[:]
+        layer_a.top.append(layer_a.name)
+        layer_b = compressed.layer.add()
+        layer_b.CopyFrom(layer)
+        layer_b.name = layer.name + postfix[1]
+        del layer_b.bottom[:]
+        layer_b.bottom.append(layer_a.name)
+        if layer.type == 'Convolution':
+            layer_a.convolution_param.num_output = ranks[layer.name]
+            param = layer_b.convolution_param
+            for field in param.DESCRIPTOR.fields:
+                if field.name in ['pad', 'pad_h', 'pad_w', 'kernel_size', \
+                                  'kernel_h', 'kernel_w', 'stride', \
+                                  'stride_h', 'stride_w', 'dilation', 'group']:
+                    param.ClearField(field.name)
+            if param.DESCRIPTOR.fields_by_name['kernel_size'].label == \
+               param.DESCRIPTOR.fields_by_name['kernel_size'].LABEL_REPEATED:
+                param.kernel_size.append(1)
+            else:
+                param.kernel_size = 1
+        else:
+            layer_a.inner_product_param.num_output = ranks[layer.name]
+    return compressed
+
+
+def WriteCompressedProto(proto_src, proto_dest, ranks, postfix=('_a', '_b')):
+    from caffe.proto import caffe_pb2
+    from google.protobuf import text_format
+    proto = caffe_pb2.NetParameter()
+    f = open(proto_src, 'r')
+    text_format.Merge(f.read(), proto)
+    f.close()
+    f = open(proto_dest, 'w')
+    f.write(text_format.MessageToString(CompressedProto(proto, ranks, postfix)))
+    f.close()
+
+
+
+#############################################################################
+# 4. Main module
+#############################################################################
+
+def ParseArgs():
+    import sys, argparse
+    parser = argparse.ArgumentParser(description='Rank allocation for low-rank compression')
+    parser.add_argument('proto_src',
+                        help='original network prototxt')
+    parser.add_argument('model_src',
+                        help='original caffemodel')
+    parser.add_argument('proto_dest',
+                        help='compressed network prototxt to be written')
+    parser.add_argument('--budget', dest='budget',
+                        help='total MACs of conv & FC layers, '
+                             'or ratio to original if <= 1',
+                        default=0.5, type=float)
+    parser.add_argument('--latency', dest='latency',
+                        help='latency budget (ms) instead of --budget, '
+                             'requires --macs_per_ms',
+                        default=None, type=float)
+    parser.add_argument('--macs_per_ms', dest='macs_per_ms',
+                        help='measured throughput of conv & FC layers',
+                        default=None, type=float)
+    parser.add_argument('--layers', dest='layers',
+                        help='layers to be compressed (default: all conv & FC)',
+                        default=None, type=str, nargs='*')
+    parser.add_argument('--num_rois', dest='num_rois',
+                        help='number of FC layer inputs per image, '
+                             'e.g., 300 for Faster R-CNN',
+                        default=None, type=int)
+    parser.add_argument('--min_rank', dest='min_rank',
+                        help='minimum rank of each layer',
+                        default=1, type=int)
+    parser.add_argument('--postfix', dest='postfix',
+                        help='names of two compressed layers',
+                        default=['_a', '_b'], type=str, nargs=2)
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args()
+    if args.latency is not None and args.macs_per_ms is None:
+        parser.error('--latency requires --macs_per_ms')
+    return args
+
+
+if __name__ == "__main__":
+    import caffe
+    args = ParseArgs()
+    caffe.set_mode_cpu()
+    net = caffe.Net(args.proto_src, args.model_src, caffe.TEST)
+    layers = CollectLayers(net, args.layers, args.num_rois)
+    budget = args.budget
+    if args.latency is not None:
+        budget = args.latency * args.macs_per_ms
+    ranks = AllocateRanks(layers, budget, args.min_rank)
+    ShowRanks(layers, ranks)
+    WriteCompressedProto(args.proto_src, args.proto_dest, ranks, args.postfix)
+    print "'layers': %s," % str(RankConfig(layers, ranks))
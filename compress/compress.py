@@ -9,11 +9,17 @@
 #   7. Main module
 #############################################################################
 
+import os
+import sys
 import numpy as np
 import skimage
 import datetime
 from random import shuffle
 
+# Truncated SVD shared with dl.compress_fc (see dl.truncated_svd)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dl import truncated_svd
+
 
 
 #############################################################################
@@ -27,6 +33,12 @@ from random import shuffle
 num_train_images = 2000
 sample_per_image = 48
 
+# Randomized SVD for FC layer compression (see dl.randomized_svd)
+#   fc_oversampling: Number of extra random vectors, None for exact SVD
+#   fc_num_iters: Number of subspace iterations
+fc_oversampling = 10
+fc_num_iters = 2
+
 
 
 #############################################################################
@@ -381,43 +393,19 @@ def CompressConvKernel(W_true, b_true, rank):
 # 5. Fully-connected layer compression modoules
 #############################################################################
 
-# Core module for FC layer compression (= Truncaated SVD)
-def CompressFCLayerCore(W_true, rank):
-    start_time = datetime.datetime.now()
-
-    if W_true.shape[0] > W_true.shape[1]:
-        W = W_true.transpose().copy()
-    else:
-        W = W_true.copy()
-
-    # Do eigen decomposition along smaller dimension
-    WWT = np.tensordot(W, W, (1, 1))
-    D, U = np.linalg.eigh(WWT)
-    U = U[:, -rank:]
-    S_inv = np.diag(1.0 / np.sqrt(D[-rank:]))
-    VT = np.dot(np.tensordot(S_inv, U, (1, 1)), W)
-    S_sqrt = np.diag(np.sqrt(np.sqrt(D[-rank:])))
-
-    # Obtain P, Q such that W_true ~= P * Q
-    if W_true.shape[0] > W_true.shape[1]:
-        P = np.dot(VT.transpose(), S_sqrt)
-        Q = np.dot(S_sqrt, U.transpose())
-    else:
-        P = np.dot(U, S_sqrt)
-        Q = np.dot(S_sqrt, VT)
-    energy = D[-rank:].sum() / D.sum()
-
-    # Print approximation accuracy in terms of L2 loss
-    elapsed_time = (datetime.datetime.now() - start_time).total_seconds()
-    print 'Truncated SVD Accumulative Energy = %.4f' % energy
-    return (P, Q)
+# Core module for FC layer compression (= Truncaated SVD, see dl.truncated_svd)
+#   oversampling, num_iters:  See dl.randomized_svd
+#   P, Q are in the dtype of W_true
+#   If oversampling is None, do exact eigen decomposition in float64
+def CompressFCLayerCore(W_true, rank, oversampling=10, num_iters=2):
+    return truncated_svd(W_true, rank, oversampling, num_iters)
 
 
 # Outer module for FC layer compression
 def CompressFCLayer(W_true, b_true, rank):
     # Decompose original weight matrix:  W_true ~= P * Q
     #   W_true:  D' x D,  P:  D' x R,  Q:  R x D
-    P, Q = CompressFCLayerCore(W_true, rank)
+    P, Q = CompressFCLayerCore(W_true, rank, fc_oversampling, fc_num_iters)
 
     # Parameters for the compression layer
     #   Compression layer (R x D):  W1 = Q,  b1 = 0
@@ -435,6 +423,14 @@ def CompressFCLayer(W_true, b_true, rank):
 # 6. Outer loop of the algorithm
 #############################################################################
 
+# Type of a layer in a caffe network, e.g., 'Convolution', 'InnerProduct'
+#   Layers are compressed by type rather than by name, since layer names
+#   given by allocate.py need not contain 'conv' or 'fc',
+#   e.g., rpn_cls_score, cls_score, bbox_pred in Faster R-CNN
+def LayerType(net, layer):
+    return net.layers[list(net._layer_names).index(layer)].type
+
+
 def Compression(cfgs):
     # Load original and compressed networks
     # Please prepare the following three files
@@ -459,13 +455,16 @@ def Compression(cfgs):
         b_true = true_net.params[layer][1].data
 
         # Compression
-        if 'conv' in layer:
+        layer_type = LayerType(true_net, layer)
+        if layer_type == 'Convolution':
             Y_true, Y_dirty = \
                 MakeTrainingDataset(cfgs, layer, true_net, compressed_net)
             W1, b1, W2, b2 = \
                 CompressConvLayer(Y_true, Y_dirty, W_true, b_true, rank)
-        elif 'fc' in layer:
+        elif layer_type == 'InnerProduct':
             W1, b1, W2, b2 = CompressFCLayer(W_true, b_true, rank)
+        else:
+            raise ValueError('Cannot compress %s layer: %s' % (layer_type, layer))
 
         # Update compressed network parameters
         compressed_net.params[layer + '_a'][0].data[:] = W1
@@ -501,7 +500,8 @@ def Compression3D(cfgs):
         b_true = true_net.params[layer][1].data
 
         # Compression
-        if 'conv' in layer:
+        layer_type = LayerType(true_net, layer)
+        if layer_type == 'Convolution':
             # C' x C x kh x kw  ->  R x C x kh x 1  and  C' x R x 1 x kw
             W1, b1, W2, b2 = CompressConvKernel(W_true, b_true, rank)
             compressed_net.params[layer + '_kh'][0].data[:] = W1
@@ -519,12 +519,14 @@ def Compression3D(cfgs):
             compressed_net.params[layer + '_kw_a'][1].data[:] = b1
             compressed_net.params[layer + '_kw_b'][0].data[:] = W2
             compressed_net.params[layer + '_kw_b'][1].data[:] = b2
-        elif 'fc' in layer:
+        elif layer_type == 'InnerProduct':
             W1, b1, W2, b2 = CompressFCLayer(W_true, b_true, rank)
             compressed_net.params[layer + '_a'][0].data[:] = W1
             compressed_net.params[layer + '_a'][1].data[:] = b1
             compressed_net.params[layer + '_b'][0].data[:] = W2
             compressed_net.params[layer + '_b'][1].data[:] = b2
+        else:
+            raise ValueError('Cannot compress %s layer: %s' % (layer_type, layer))
 
     # Save the compressed network as: ./caffemodel/compressed_3d.caffemodel
     compressed_net.save('./caffemodel/compressed_3d.caffemodel')
@@ -0,0 +1,77 @@
+#############################################################################
+# Tests of rank allocation (see allocate.py)
+#   python -m unittest test_allocate  (run in this directory)
+#############################################################################
+
+import unittest
+import numpy as np
+from allocate import LayerInfo, LayerMACs, LayerEnergy, AllocateRanks, \
+                     RankConfig
+
+
+
+# Synthetic conv & FC layers with decaying spectra
+#   W = U * diag(s) * V' with singular values s[i] = decay^i
+def SyntheticLayer(name, layer_type, out_dim, in_dim, decay, positions):
+    rng = np.random.RandomState(len(name))
+    rank = min(out_dim, in_dim)
+    U = np.linalg.qr(rng.randn(out_dim, rank))[0]
+    V = np.linalg.qr(rng.randn(in_dim, rank))[0]
+    s = decay ** np.arange(rank)
+    W = np.dot(U * s, V.T).astype(np.float32)
+    return LayerInfo(name, layer_type, W, positions)
+
+
+class AllocateRanksTest(unittest.TestCase):
+    def setUp(self):
+        self.layers = [
+            SyntheticLayer('conv1', 'conv', 64, 27, 0.7, 10000),
+            SyntheticLayer('conv2', 'conv', 128, 576, 0.9, 2500),
+            SyntheticLayer('rpn_cls_score', 'conv', 36, 128, 0.8, 2500),
+            SyntheticLayer('fc6', 'fc', 256, 1024, 0.97, 300),
+            SyntheticLayer('cls_score', 'fc', 21, 256, 0.6, 300),
+        ]
+        self.total = sum([LayerMACs(layer, None) for layer in self.layers])
+
+    def TotalMACs(self, ranks):
+        return sum([LayerMACs(layer, ranks[layer['name']]) \
+                    for layer in self.layers])
+
+    def test_budget(self):
+        # Budget is met, by absolute MACs or by ratio to original
+        for ratio in [0.9, 0.5, 0.3, 0.2]:
+            for budget in [ratio, ratio * self.total]:
+                ranks = AllocateRanks(self.layers, budget)
+                self.assertLessEqual(self.TotalMACs(ranks), ratio * self.total)
+
+    def test_ranks(self):
+        # Ranks are valid and only compressed layers reduce MACs
+        ranks = AllocateRanks(self.layers, 0.3)
+        for layer in self.layers:
+            rank = ranks[layer['name']]
+            if rank is not None:
+                self.assertGreaterEqual(rank, 1)
+                self.assertLessEqual(rank, min(layer['in_dim'], layer['out_dim']))
+                self.assertLess(LayerMACs(layer, rank), LayerMACs(layer, None))
+        config = RankConfig(self.layers, ranks)
+        self.assertEqual([name for name, rank in config], \
+                         [layer['name'] for layer in self.layers \
+                          if ranks[layer['name']] is not None])
+
+    def test_energy(self):
+        # Tighter budget never retains more energy
+        log_energies = []
+        for ratio in [0.9, 0.5, 0.3]:
+            ranks = AllocateRanks(self.layers, ratio)
+            log_energies.append(sum([np.log(LayerEnergy(layer, ranks[layer['name']])) \
+                                     for layer in self.layers]))
+        self.assertEqual(log_energies, sorted(log_energies, reverse=True))
+
+    def test_infeasible(self):
+        # Budget below rank-1 layers is reported, with all layers at min_rank
+        ranks = AllocateRanks(self.layers, 1e-6)
+        self.assertEqual(set(ranks.values()), set([1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
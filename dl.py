@@ -1,24 +1,53 @@
+import os
+import sys
 import numpy as np
 
+# packed file format, shared with the runtime loader
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'loader'))
+from packfile import PackWriter, write_pack
+from packfile import quant_min_size, quantize_items
+
+
+# payloads of at least this many bytes are memory-mapped by load_data
+#   each memory map holds an open file descriptor until the array is freed,
+#   so mapping every small .bin file would run out of descriptors
+#   (e.g., ulimit -n 256) when a whole parameter directory is loaded
+mmap_min_size = 1 << 20
+
 
 def load_data(filename):
+  # return payload as float32 array
+  #   a large payload is a copy-on-write memory map, so that data is read
+  #   from disk only when it is accessed, and changes are never written back
+  #   a small one is read into memory, and the file is closed
+  #   to access many arrays without reading them all, use a packed file
+  #   (pack_bin, packfile.load_pack), which maps all of them with a single
+  #   descriptor
   from struct import pack, unpack
   f = open(filename, 'rb')
   ndim = unpack("i", f.read(4))[0]
-  shape = np.frombuffer(f.read(ndim * 4), dtype=np.int32, count=-1)
-  data = np.fromfile(f, dtype=np.float32).reshape(shape)
+  shape = tuple(np.frombuffer(f.read(ndim * 4), dtype=np.int32, count=-1))
+  count = int(np.prod(shape))
+  if count * 4 < mmap_min_size:
+    data = np.fromfile(f, dtype=np.float32, count=count)
+    f.close()
+    return data.reshape(shape)
   f.close()
-  return data
+  return np.memmap(filename, dtype=np.float32, mode='c', offset=4 + 4 * ndim, shape=shape)
 
 
 def save_data(filename, data):
+  # written to a temporary file and then renamed, so that arrays mapped
+  # from the old file by load_data remain valid
+  import os
   from struct import pack, unpack
-  f = open(filename, 'wb')
+  f = open(filename + '.tmp', 'wb')
   ndim = len(data.shape)
   f.write(pack('i', ndim))
   f.write(pack('i' * ndim, *data.shape))
-  data.tofile(f)
+  np.ascontiguousarray(data, dtype=np.float32).tofile(f)
   f.close()
+  os.rename(filename + '.tmp', filename)
 
 
 def load_inception(proto_src, proto_dest, model_src):
@@ -33,84 +62,203 @@ def load_inception(proto_src, proto_dest, model_src):
   return net_dest
 
 
-def combine_conv_bn_scale_pva33(net):
+def bn_triples_pva33(net):
+  # list of (conv, bn, scale) layer names in PVA 3.3 naming
+  triples = []
   for name in net._layer_names:
     if name.endswith('/bn'):
-      key_conv = name[:-3]
-      key_bn = name
-      key_scale = name[:-3] + '/scale'
-    else:
-      continue
-    combine_conv_bn_scale(net, key_conv, key_bn, key_scale)
+      triples.append((name[:-3], name, name[:-3] + '/scale'))
+  return triples
 
 
-def combine_conv_bn_scale_pva900(net):
+def bn_triples_pva900(net):
+  # list of (conv, bn, scale) layer names in PVA 9.0.0 naming
+  triples = []
   for name in net._layer_names:
     if name.endswith('/bn'):
       if name.startswith('fc'):
-        key_conv = name[:-3]
-        key_bn = name
-        key_scale = name[:-3] + '/scale'
+        triples.append((name[:-3], name, name[:-3] + '/scale'))
       else:
-        key_conv = name[:-3] + '/conv'
-        key_bn = name
-        key_scale = name + '_scale'
+        triples.append((name[:-3] + '/conv', name, name + '_scale'))
     elif name.endswith('/proj_bn'):
-      key_conv = name[:-3]
-      key_bn = name
-      key_scale = name + '_scale'
-    else:
-      continue
-    combine_conv_bn_scale(net, key_conv, key_bn, key_scale)
+      triples.append((name[:-3], name, name + '_scale'))
+  return triples
 
 
-def combine_conv_bn_scale(net, key_conv, key_bn, key_scale):
-  def copy_double(data):
-    return np.array(data, copy=True, dtype=np.double)
+def combine_conv_bn_scale_pva33(net, num_samples=0):
+  return fold_bn(net, bn_triples_pva33(net), num_samples)
 
-  if not net.params.has_key(key_bn):
-    print 'No batch norm layer {:s} to be combined'.format(key_bn)
-    return
-  if not net.params.has_key(key_conv):
-    print '[ERROR] Cannot find conv layer {:s}'.format(key_conv)
-    return
 
-  bn_mean = copy_double(net.params[key_bn][0].data)
-  bn_variance = copy_double(net.params[key_bn][1].data)
-  num_bn_samples = copy_double(net.params[key_bn][2].data)
-  net.params[key_bn][0].data[:] = 0
-  net.params[key_bn][1].data[:] = 1
-  net.params[key_bn][2].data[:] = 1
-  if num_bn_samples[0] == 0:
-    num_bn_samples[0] = 1
-
-  if net.params.has_key(key_scale):
-    print 'Combine {:s} + {:s} + {:s}'.format(key_conv, key_bn, key_scale)
-    scale_weight = copy_double(net.params[key_scale][0].data)
-    scale_bias = copy_double(net.params[key_scale][1].data)
-    net.params[key_scale][0].data[:] = 1
-    net.params[key_scale][1].data[:] = 0
-  else:
-    print 'Combine {:s} + {:s}'.format(key_conv, key_bn)
-    scale_weight = 1
-    scale_bias = 0
+def combine_conv_bn_scale_pva900(net, num_samples=0):
+  return fold_bn(net, bn_triples_pva900(net), num_samples)
 
-  weight = copy_double(net.params[key_conv][0].data)
-  bias = copy_double(net.params[key_conv][1].data)
-  alpha = scale_weight / np.sqrt(bn_variance / num_bn_samples[0] + np.finfo(np.double).eps)
-  net.params[key_conv][1].data[:] = bias * alpha + (scale_bias - (bn_mean / num_bn_samples[0]) * alpha)
-  for i in range(len(alpha)):
-    net.params[key_conv][0].data[i] = weight[i] * alpha[i]
 
+def combine_conv_bn_scale(net, key_conv, key_bn, key_scale):
+  return fold_bn(net, [(key_conv, key_bn, key_scale)])
+
+
+def fold_bn(net, triples, num_samples=0, inputs=None, end=None):
+  # fold BatchNorm (+ Scale) layers into preceding conv or fc layers
+  #   W[o] <- W[o] * alpha[o],
+  #   b[o] <- b[o] * alpha[o] + (beta[o] - mean[o] * alpha[o]),
+  #   alpha[o] = gamma[o] / sqrt(var[o] + eps)
+  #   and then BatchNorm & Scale are reset to identity
+  #   triples: list of (conv, bn, scale) layer names, e.g., bn_triples_pva33
+  #   all factors are computed first, and then each layer is updated
+  #   by a single broadcasted multiply
+  #   num_samples: if > 0, outputs of bn (or scale) layers and of the network
+  #                are compared before and after folding, for num_samples
+  #                random inputs (or given inputs: list of dicts of input
+  #                blobs for net.forward, forwarded until layer end)
+  #   return dict: blob name -> max abs error (empty if num_samples == 0)
+  def copy_double(data):
+    return np.array(data, copy=True, dtype=np.double)
 
-def truncated_svd(W_true, rank):
+  folds = []
+  for key_conv, key_bn, key_scale in triples:
+    if not net.params.has_key(key_bn):
+      print 'No batch norm layer {:s} to be combined'.format(key_bn)
+      continue
+    if not net.params.has_key(key_conv):
+      print '[ERROR] Cannot find conv layer {:s}'.format(key_conv)
+      continue
+    num_bn_samples = net.params[key_bn][2].data[0]
+    if num_bn_samples == 0:
+      num_bn_samples = 1
+    bn_mean = copy_double(net.params[key_bn][0].data) / num_bn_samples
+    bn_variance = copy_double(net.params[key_bn][1].data) / num_bn_samples
+    if net.params.has_key(key_scale):
+      print 'Combine {:s} + {:s} + {:s}'.format(key_conv, key_bn, key_scale)
+      scale_weight = copy_double(net.params[key_scale][0].data)
+      scale_bias = copy_double(net.params[key_scale][1].data)
+    else:
+      print 'Combine {:s} + {:s}'.format(key_conv, key_bn)
+      key_scale = None
+      scale_weight = 1
+      scale_bias = 0
+    alpha = scale_weight / np.sqrt(bn_variance + np.finfo(np.double).eps)
+    folds.append((key_conv, key_bn, key_scale, alpha, scale_bias - bn_mean * alpha))
+
+  names = []
+  if num_samples > 0 or inputs is not None:
+    for key_conv, key_bn, key_scale, alpha, shift in folds:
+      names.extend(net.top_names[key_scale or key_bn])
+    names.extend(net.outputs)
+    names = [name for i, name in enumerate(names) if name not in names[:i]]
+    if inputs is None:
+      rng = np.random.RandomState(0)
+      inputs = [dict([(name, rng.standard_normal(net.blobs[name].data.shape)) \
+                      for name in net.inputs]) for i in range(num_samples)]
+    outputs_before = _forward_blobs(net, inputs, names, end)
+
+  for key_conv, key_bn, key_scale, alpha, shift in folds:
+    weight = net.params[key_conv][0].data
+    bias = net.params[key_conv][1].data
+    weight[...] = (weight.reshape((alpha.size, -1)) * alpha.reshape((-1, 1))).reshape(weight.shape)
+    bias[...] = bias * alpha + shift
+    net.params[key_bn][0].data[...] = 0
+    net.params[key_bn][1].data[...] = 1
+    net.params[key_bn][2].data[...] = 1
+    if key_scale is not None:
+      net.params[key_scale][0].data[...] = 1
+      net.params[key_scale][1].data[...] = 0
+
+  errors = {}
+  if len(names) > 0:
+    outputs_after = _forward_blobs(net, inputs, names, end)
+    for name in names:
+      errors[name] = max([np.abs(before[name] - after[name]).max() \
+                          for before, after in zip(outputs_before, outputs_after)])
+      scale = max([np.abs(before[name]).max() for before in outputs_before])
+      print '  {:s}: max abs error = {:.6g} (max abs value = {:.6g})'.format( \
+            name, errors[name], scale)
+  return errors
+
+
+def _forward_blobs(net, inputs, names, end=None):
+  # copies of blobs in names after forward pass for each of inputs
+  outputs = []
+  for data in inputs:
+    net.forward(end=end, **data)
+    outputs.append(dict([(name, net.blobs[name].data.copy()) for name in names]))
+  return outputs
+
+
+def randomized_svd(W, rank, oversampling=10, num_iters=2, block_size=1024, seed=0):
+  # top-rank singular triplets of W (m x n) by randomized range finder
+  # with subspace iteration, in float32
+  #   W is read in blocks of block_size columns at each pass, so that
+  #   it can be, e.g., a memory-mapped array (see packfile.load_pack)
+  #   oversampling: number of extra random vectors,
+  #   num_iters: number of subspace iterations (passes over W),
+  #   both give more accurate results for larger values
+  #   return (U: m x rank, S: rank, VT: rank x n, energy)
+  #     energy: captured ratio ||U S VT||_F^2 / ||W||_F^2
+  m, n = W.shape
+  size = min(rank + oversampling, m, n)
+  blocks = [slice(begin, min(begin + block_size, n)) for begin in range(0, n, block_size)]
+  def block(b):
+    return np.asarray(W[:, b], dtype=np.float32)
+
+  # range finder: Y = W * Omega, Omega: n x size Gaussian random matrix
+  rng = np.random.RandomState(seed)
+  Y = np.zeros((m, size), dtype=np.float32)
+  total_energy = 0.0
+  for b in blocks:
+    W_b = block(b)
+    Y += np.dot(W_b, rng.standard_normal((W_b.shape[1], size)).astype(np.float32))
+    total_energy += np.square(W_b, dtype=np.double).sum()
+  Q = np.linalg.qr(Y)[0]
+
+  # subspace iteration: Q <- orth(W * orth(W' * Q))
+  for i in range(num_iters):
+    Z = np.empty((n, size), dtype=np.float32)
+    for b in blocks:
+      Z[b] = np.dot(block(b).T, Q)
+    Z = np.linalg.qr(Z)[0]
+    Y = np.zeros((m, size), dtype=np.float32)
+    for b in blocks:
+      Y += np.dot(block(b), Z[b])
+    Q = np.linalg.qr(Y)[0]
+
+  # SVD of small matrix B = Q' * W (size x n),
+  # by eigen decomposition of B * B' (size x size) in float64
+  B = np.empty((size, n), dtype=np.float32)
+  for b in blocks:
+    B[:, b] = np.dot(Q.T, block(b))
+  D, U_B = np.linalg.eigh(np.dot(B.astype(np.double), B.T.astype(np.double)))
+  D = np.maximum(D[::-1][:rank], 0)
+  U_B = U_B[:, ::-1][:, :rank]
+  S = np.sqrt(D)
+  S_inv = np.where(S > 0, 1.0 / np.maximum(S, np.finfo(np.double).tiny), 0)
+  U = np.dot(Q, U_B.astype(np.float32))
+  VT = np.dot((U_B * S_inv.reshape((1, -1))).T.astype(np.float32), B)
+  energy = D.sum() / max(total_energy, np.finfo(np.double).tiny)
+  return (U, S.astype(np.float32), VT, energy)
+
+
+def truncated_svd(W_true, rank, oversampling=10, num_iters=2):
+  # W_true ~ P * Q,  W_true: D' x D,  P: D' x R,  Q: R x D
+  #   oversampling, num_iters: see randomized_svd
+  #   if oversampling is None, exact eigen decomposition of W W' is done
+  #   in float64 instead
+  #   P & Q are returned in the dtype of W_true for both methods
   import datetime
   start_time = datetime.datetime.now()
 
+  if oversampling is not None:
+    U, S, VT, energy = randomized_svd(W_true, rank, oversampling, num_iters)
+    S_sqrt = np.sqrt(S)
+    P = U * S_sqrt.reshape((1, -1))
+    Q = VT * S_sqrt.reshape((-1, 1))
+    elapsed_time = (datetime.datetime.now() - start_time).total_seconds()
+    print 'Truncated SVD Accumulative Energy = %.4f (%.2fs)' % (energy, elapsed_time)
+    return (P.astype(W_true.dtype), Q.astype(W_true.dtype))
+
   if W_true.shape[0] > W_true.shape[1]:
-    W = W_true.transpose().copy()
+    W = np.array(W_true.transpose(), dtype=np.double)
   else:
-    W = W_true.copy()
+    W = np.array(W_true, dtype=np.double)
 
   WWT = np.tensordot(W, W, (1, 1))
   D, U = np.linalg.eigh(WWT)
@@ -128,8 +276,8 @@ def truncated_svd(W_true, rank):
   energy = D[-rank:].sum() / D.sum()
 
   elapsed_time = (datetime.datetime.now() - start_time).total_seconds()
-  print 'Truncated SVD Accumulative Energy = %.4f' % energy
-  return (P, Q)
+  print 'Truncated SVD Accumulative Energy = %.4f (%.2fs)' % (energy, elapsed_time)
+  return (P.astype(W_true.dtype), Q.astype(W_true.dtype))
 
 
 def compress_fc(net, key_fc):
@@ -148,7 +296,7 @@ def compress_fc(net, key_fc):
     print '[ERROR] Cannot find fc reconstruction layer {:s}'.format(key_U)
     return
 
-  W_true = copy_double(net.params[key_fc][0].data)
+  W_true = net.params[key_fc][0].data
   b_true = copy_double(net.params[key_fc][1].data)
   true_rank = net.params[key_fc][0].data.shape[0]
   rank = net.params[key_L][0].data.shape[0]
@@ -173,14 +321,166 @@ def save_bin(net, path):
       save_data(key, net.params[name][param_id].data)
 
 
+# packed parameter file: PackWriter, write_pack
+#   defined in loader/packfile.py, shared with the runtime loader,
+#   which also has the reader (packfile.load_pack, packfile.read_pack)
+
+
+def append_pack(filename, items):
+  # add (name, array) items to a packed file, or create it
+  write_pack(filename, items, append=True)
+
+
+def save_blobs(net, filename, prefix='', append=True):
+  # dump all blobs of caffe net to a packed file, as '{prefix}{blob name}'
+  #   e.g., call after each forward pass with prefix = image id
+  writer = PackWriter(filename, append=append)
+  for name in net.blobs.keys():
+    writer.write(prefix + name, net.blobs[name].data)
+  writer.close()
+
+
+# quantized parameters in packed file: quantize_items
+#   defined in loader/packfile.py, together with packfile.quantize_int8
+#   and the loader's packfile.dequantize
+
+
+def save_pack(net, filename, mode=None, min_size=quant_min_size, clips=None):
+  # all parameters in a single packed file, as float32
+  #   array names are same as save_bin's filenames, without '.bin'
+  #   mode: 'int8' or 'fp16' to quantize large weights (see quantize_items)
+  def items():
+    for name in net.params.keys():
+      for param_id in range(len(net.params[name])):
+        key = '{:s}_param{:d}'.format(name.replace('/', '_'), param_id)
+        yield (key, net.params[name][param_id].data.astype(np.float32))
+  if mode is None:
+    write_pack(filename, items())
+  else:
+    write_pack(filename, quantize_items(items(), mode, min_size, clips))
+
+
+def pack_bin(path, filename, mode=None, min_size=quant_min_size, clips=None):
+  # convert all .bin files in path (written by save_bin) to a packed file
+  #   mode: 'int8' or 'fp16' to quantize large weights (see quantize_items)
+  import os
+  def items():
+    for name in sorted(os.listdir(path)):
+      if name.endswith('.bin'):
+        yield (name[:-4], load_data(os.path.join(path, name)).astype(np.float32))
+  if mode is None:
+    write_pack(filename, items())
+  else:
+    write_pack(filename, quantize_items(items(), mode, min_size, clips))
+
+
+def class_rows(classes, num_values=1):
+  # row indices of a class-wise layer for given classes, in given order
+  #   num_values: number of outputs per class, e.g., 4 for bbox_pred
+  classes = np.asarray(classes, dtype=np.int32).reshape((-1, 1))
+  return (classes * num_values + np.arange(num_values)).ravel()
+
+
 def convert_pvtdb_to_voc(net):
   order = [0,11,1,2,12,13,3,4,5,14,15,16,6,7,8,9,17,18,19,10,20]
-  net.params['cls_score'][0].data[...] = net.params['cls_score'][0].data[order,:]
-  net.params['cls_score'][1].data[...] = net.params['cls_score'][1].data[order]
-  temp = net.params['bbox_pred'][0].data.reshape(21,4,4096)
-  net.params['bbox_pred'][0].data[...] = temp[order,:,:].reshape(84,4096)
-  temp = net.params['bbox_pred'][1].data.reshape(21,4)
-  net.params['bbox_pred'][1].data[...] = temp[order,:].reshape(84)
+  for param in net.params['cls_score']:
+    param.data[...] = param.data[class_rows(order)]
+  for param in net.params['bbox_pred']:
+    param.data[...] = param.data[class_rows(order, 4)]
+
+
+# class pruning of RCNN heads
+#   keep: list of classes to keep, class c of pruned network is
+#         class keep[c] of original network
+#         background (class 0) is always kept as class 0
+#   cls_score is reduced to len(keep) outputs, and bbox_pred to
+#   4 * len(keep) outputs unless it is class-agnostic
+#   the runtime takes the number of classes from cls_prob, so no other
+#   layer needs to be changed, but scores are normalized by softmax
+#   over kept classes only
+def pruned_classes(keep):
+  keep = [int(c) for c in keep if c != 0]
+  return [0] + keep
+
+
+def prune_proto(proto, keep, key_score='cls_score', key_bbox='bbox_pred'):
+  # reduce num_output of heads in caffe_pb2.NetParameter, in place,
+  # and update 'num_classes' in param_str of Python layers
+  import re
+  keep = pruned_classes(keep)
+  num_classes = [layer.inner_product_param.num_output \
+                 for layer in proto.layer if layer.name == key_score][0]
+  for layer in proto.layer:
+    if layer.name == key_score:
+      layer.inner_product_param.num_output = len(keep)
+    elif layer.name == key_bbox and layer.inner_product_param.num_output == 4 * num_classes:
+      layer.inner_product_param.num_output = 4 * len(keep)
+    elif layer.type == 'Python':
+      layer.python_param.param_str = re.sub(r"""(['"]num_classes['"]\s*:\s*)\d+""",
+          lambda match: '{:s}{:d}'.format(match.group(1), len(keep)),
+          layer.python_param.param_str)
+  return proto
+
+
+def save_pruned_proto(proto_src, proto_dest, keep, key_score='cls_score', key_bbox='bbox_pred'):
+  from caffe.proto import caffe_pb2
+  from google.protobuf import text_format
+  proto = caffe_pb2.NetParameter()
+  f = open(proto_src, 'r')
+  text_format.Merge(f.read(), proto)
+  f.close()
+  prune_proto(proto, keep, key_score, key_bbox)
+  f = open(proto_dest, 'w')
+  f.write(text_format.MessageToString(proto))
+  f.close()
+
+
+def prune_params(name, data, keep, num_classes, key_score='cls_score', key_bbox='bbox_pred'):
+  # parameter array of pruned network
+  #   name: layer name, data: parameter array of original network
+  keep = pruned_classes(keep)
+  if name == key_score:
+    return data[class_rows(keep)]
+  if name == key_bbox and data.shape[0] == 4 * num_classes:
+    return data[class_rows(keep, 4)]
+  return data
+
+
+def prune_classes(net_src, net_dest, keep, key_score='cls_score', key_bbox='bbox_pred'):
+  # copy parameters of net_src to pruned network net_dest
+  #   net_dest: built from prototxt written by save_pruned_proto
+  num_classes = net_src.params[key_score][0].data.shape[0]
+  for key in net_src.params.keys():
+    for i in range(len(net_src.params[key])):
+      net_dest.params[key][i].data[...] = \
+          prune_params(key, net_src.params[key][i].data, keep, num_classes, key_score, key_bbox)
+
+
+def prune_bin(path_src, path_dest, keep, key_score='cls_score', key_bbox='bbox_pred'):
+  # prune .bin files in path_src (written by save_bin) to path_dest
+  import os
+  if not os.path.isdir(path_dest):
+    os.makedirs(path_dest)
+  key_score = key_score.replace('/', '_')
+  key_bbox = key_bbox.replace('/', '_')
+  num_classes = load_data('{:s}/{:s}_param0.bin'.format(path_src, key_score)).shape[0]
+  for name in sorted(os.listdir(path_src)):
+    if name.endswith('.bin'):
+      data = load_data(os.path.join(path_src, name))
+      data = prune_params(name[:-4].rsplit('_param', 1)[0], data, keep, num_classes,
+                          key_score, key_bbox)
+      save_data(os.path.join(path_dest, name), np.ascontiguousarray(data))
+
+
+def load_pruned(proto_src, proto_dest, model_src, keep):
+  # write pruned prototxt to proto_dest, and return pruned caffe net
+  import caffe
+  caffe.set_mode_cpu()
+  save_pruned_proto(proto_src, proto_dest, keep)
+  net_src = caffe.Net(proto_src, model_src, caffe.TEST)
+  net_dest = caffe.Net(proto_dest, caffe.TEST)
+  prune_classes(net_src, net_dest, keep)
+  return net_dest
 
 
 def parse_args():
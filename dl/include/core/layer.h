@@ -45,7 +45,10 @@ typedef struct LayerOption_
   int flatten_shape;
 
   // for rectified linear unit (ReLU) operator
+  //   fused_relu: if nonzero, conv and eltwise operators apply
+  //               (soft-)ReLU to their outputs in-place
   real negative_slope;
+  int fused_relu;
 
   // for proposal and odout operators
   real* anchor_scales;
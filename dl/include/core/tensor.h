@@ -15,6 +15,7 @@
 #define SHARED_DATA 0  // data uses a block of shared memory
 #define PRIVATE_DATA 1  // data has its own private memory
 #define PARAM_DATA 2  // has own memory & pre-trained parameter is loaded
+#define SHARED_PARAM_DATA 3  // refers to parameter memory of another network
 
 
 
@@ -96,6 +96,10 @@ Layer* add_relu_layer(Net* const net,
                       const char* const top_name,
                       const real negative_slope);
 
+Layer* fuse_relu_layer(Net* const net,
+                       const char* const layer_name,
+                       const real negative_slope);
+
 Layer* add_dropout_layer(Net* const net,
                          const char* const layer_name,
                          const char* const bottom_name,
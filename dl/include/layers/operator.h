@@ -20,6 +20,21 @@ void shape_image_layer(void* const net_, void* const layer_);
 void init_image_layer(void* const net_, void* const layer_);
 void free_image_layer(void* const net_, void* const layer_);
 
+// size of resized input for a raw image, as done by the image layer
+//   callable from external environments via shared library
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+void compute_scaled_size(const int raw_h, const int raw_w,
+                         const int input_size, const int unit_size,
+                         real* const p_scale_h, real* const p_scale_w,
+                         int* const p_resized_h, int* const p_resized_w);
+
+#ifdef __cplusplus
+} // end extern "C"
+#endif
+
 
 
 // --------------------------------------------------------------------------
@@ -141,6 +156,12 @@ void shape_relu_layer(void* const net_, void* const layer_);
 void init_relu_layer(void* const net_, void* const layer_);
 void free_relu_layer(void* const net_, void* const layer_);
 
+// (soft-)ReLU transform bottom -> top, bottom = top allowed
+//   used by operators with fused ReLU (option->fused_relu)
+void relu_forward(const Tensor* const bottom,
+                  Tensor* const top,
+                  const LayerOption* const option);
+
 
 
 // --------------------------------------------------------------------------
@@ -22,6 +22,15 @@ long int malloc_tensor_data(Tensor* const tensor,
 {
   long int space = get_data_size(tensor) * sizeof(real);
 
+  // data was already set to refer to another network's parameter
+  if (tensor->data_type == SHARED_PARAM_DATA) {
+    if (!tensor->data) {
+      printf("[ERROR] Tensor %s: No shared parameter memory is given\n",
+             tensor->name);
+    }
+    return 0;
+  }
+
   if (tensor->data) {
     printf("[ERROR] Tensor %s already refers to some memory\n",
            tensor->name);
@@ -61,7 +70,8 @@ void free_tensor_data(Tensor* const tensor)
            tensor->name);
   }
 
-  else if (tensor->data_type != SHARED_DATA) {
+  else if (tensor->data_type != SHARED_DATA &&
+           tensor->data_type != SHARED_PARAM_DATA) {
     #ifdef GPU
     cudaFree(tensor->data);
     #else
@@ -563,6 +563,10 @@ void forward_conv_layer(void* const net_, void* const layer_)
   conv_forward(get_bottom(layer, 0), get_top(layer, 0),
                get_param(layer, 0), p_bias,
                net->temp_data, net->const_data, &layer->option);
+
+  if (layer->option.fused_relu) {
+    relu_forward(get_top(layer, 0), get_top(layer, 0), &layer->option);
+  }
 }
 
 void shape_conv_layer(void* const net_, void* const layer_)
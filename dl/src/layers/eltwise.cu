@@ -106,6 +106,10 @@ void forward_eltwise_layer(void* const net_, void* const layer_)
   Layer* const layer = (Layer*)layer_;
   eltwise_forward(layer->p_bottoms, get_top(layer, 0),
                   layer->num_bottoms);
+
+  if (layer->option.fused_relu) {
+    relu_forward(get_top(layer, 0), get_top(layer, 0), &layer->option);
+  }
 }
 
 void shape_eltwise_layer(void* const net_, void* const layer_)
@@ -107,7 +107,6 @@ void bilinear_resize_cpu(const unsigned char img[],
 }
 #endif
 
-static
 void compute_scaled_size(const int raw_h, const int raw_w,
                          const int input_size, const int unit_size,
                          real* const p_scale_h, real* const p_scale_w,
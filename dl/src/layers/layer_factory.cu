@@ -312,6 +312,30 @@ Layer* add_relu_layer(Net* const net,
   return layer;
 }
 
+// fuse (soft-)ReLU into an existing conv or eltwise layer,
+// replacing a separate ReLU layer that follows it
+Layer* fuse_relu_layer(Net* const net,
+                       const char* const layer_name,
+                       const real negative_slope)
+{
+  Layer* const layer = get_layer_by_name(net, layer_name);
+
+  if (!layer) {
+    return NULL;
+  }
+
+  if (layer->f_forward != forward_conv_layer &&
+      layer->f_forward != forward_eltwise_layer) {
+    printf("[ERROR] Cannot fuse ReLU into layer %s\n", layer_name);
+    return layer;
+  }
+
+  layer->option.negative_slope = negative_slope;
+  layer->option.fused_relu = 1;
+
+  return layer;
+}
+
 Layer* add_dropout_layer(Net* const net,
                          const char* const layer_name,
                          const char* const bottom_name,
@@ -0,0 +1,276 @@
+import os
+import re
+from loader import load_proto, load_spec, param_transforms
+from loader import _read_bin, _fold_all
+from packfile import read_pack, write_pack
+from loader import input_size, unit_size, max_image_size
+from cost import infer_cost
+
+# layers having parameter tensors "{layer}_param0" (weight) and
+# "{layer}_param1" (bias, if bias_term = the last argument)
+param_layers = ['add_conv_layer', 'add_deconv_layer', 'add_fc_layer', 'add_scale_layer']
+
+# array arguments of layer creators: (creator, argument index) -> table name
+array_args = {
+  ('add_concat_layer', 1): 'bottoms',
+  ('add_eltwise_layer', 1): 'bottoms',
+  ('add_reshape_layer', 3): 'shape',
+  ('add_proposal_layer', 5): 'scales',
+  ('add_proposal_layer', 7): 'ratios',
+}
+
+def c_name(name):
+  # C identifier for a layer or tensor name
+  name = re.sub('[^0-9a-zA-Z_]', '_', name)
+  return name if not name[:1].isdigit() else '_' + name
+
+def c_literal(value):
+  # C literal for a spec argument
+  if value is None:
+    return 'NULL'
+  if isinstance(value, str):
+    return '"{:s}"'.format(value)
+  if isinstance(value, float):
+    return '{:s}f'.format(repr(value))
+  return '{:d}'.format(int(value))
+
+def c_array(values, name):
+  # static array definition
+  if isinstance(values[0], str):
+    ary = 'static const char* const {:s}[] = '.format(name)
+  elif isinstance(values[0], float):
+    ary = 'static real {:s}[] = '.format(name)
+  else:
+    ary = 'static const int {:s}[] = '.format(name)
+  return ary + '{ ' + ', '.join([c_literal(value) for value in values]) + ' };'
+
+def param_names(spec):
+  func_name, args = spec
+  if func_name not in param_layers:
+    return []
+  names = ['{:s}_param0'.format(args[0])]
+  if args[-1]:
+    names.append('{:s}_param1'.format(args[0]))
+  return names
+
+def load_params(specs, param_path):
+  # parameters of all layers in specs, with param_transforms applied
+  #   param_path: directory of .bin files, or packed parameter file
+  #   return list of (tensor name, float32 array)
+  import numpy as np
+  if os.path.isfile(param_path):
+    arrays = read_pack(param_path)
+    def read(layer_name, param_id):
+      return arrays['{:s}_param{:d}'.format(layer_name, param_id)]
+  else:
+    def read(layer_name, param_id):
+      return _read_bin('{:s}/{:s}_param{:d}.bin'.format(param_path, layer_name, param_id))
+  folded = _fold_all(specs, read)
+
+  params = []
+  for spec in specs:
+    for param_id, name in enumerate(param_names(spec)):
+      layer_name = spec[1][0]
+      if folded.has_key(layer_name) and folded[layer_name][param_id] is not None:
+        data = folded[layer_name][param_id]
+      else:
+        data = read(layer_name, param_id)
+      params.append((name, data.astype(np.float32)))
+  return params
+
+def save_params(specs, param_path, filename):
+  # write parameters with param_transforms applied, such that networks
+  # built without Python (e.g., by generate_code) can read them
+  #   filename: packed parameter file if it ends with '.pack',
+  #             otherwise directory of .bin files
+  #   return dict: tensor name -> byte offset in packed file (or None)
+  from loader import _write_bin
+  params = load_params(specs, param_path)
+  if filename.endswith('.pack'):
+    return write_pack(filename, params)
+  if not os.path.isdir(filename):
+    os.makedirs(filename)
+  for name, data in params:
+    _write_bin(os.path.join(filename, '{:s}.bin'.format(name)), data)
+  return None
+
+def generate_code(proto_name, model_name=None, weight_file=None, offsets=None,
+                  phase=1):
+  # C source of a network, built without protobuf or Python at runtime
+  #   model_name: suffix of generated functions, setup_{model_name} and
+  #               create_{model_name}, default = prototxt filename
+  #   weight_file, offsets: if given, packed parameter file (see
+  #                         save_params) is embedded into the binary
+  #                         by the assembler's .incbin
+  #   layer options and proposal anchors are baked in as constants,
+  #   and the parameter table is sized statically
+  #   param_transforms must be applied to parameters in advance
+  #   by save_params
+  if model_name is None:
+    model_name = os.path.splitext(os.path.basename(proto_name))[0]
+  model_name = c_name(model_name)
+  specs = load_spec(proto_name, phase=phase)
+  specs = [spec for spec in specs if spec[0] not in param_transforms]
+  records = infer_cost(load_proto(proto_name), phase=phase)
+
+  # output tensors created by layers, for table sizes
+  #   tops not created by runtime layers (e.g., proposal scores)
+  #   have no inferred shapes
+  tensors = set()
+  for record in records:
+    tensors.update([str(name).replace('/', '_') \
+                    for name, shape in zip(record['tops'], record['shapes'])])
+  params = []
+  for spec in specs:
+    params.extend(param_names(spec))
+  num_layers = len([spec for spec in specs if spec[0] != 'fuse_relu_layer'])
+  num_tensors = len(tensors) + len(params)
+
+  code = []
+  code.append('// {:s}: generated from {:s} by loader/codegen.py'.format( \
+              model_name, os.path.basename(proto_name)))
+  code.append('//   setup_{:s}: add all layers to net'.format(model_name))
+  code.append('//   create_{:s}: construct new network instance and return it'.format(model_name))
+  code.append('')
+  code.append('#include "nets/net_factory.h"')
+  code.append('#include <string.h>')
+  code.append('')
+  code.append('#define NUM_LAYERS {:d}'.format(num_layers))
+  code.append('#define NUM_TENSORS {:d}'.format(num_tensors))
+  code.append('#define NUM_PARAMS {:d}'.format(len(params)))
+  code.append('')
+  code.append('#if NUM_LAYERS > MAX_NUM_LAYERS || NUM_TENSORS > MAX_NUM_TENSORS')
+  code.append('#error "Too many layers or tensors for core/net.h"')
+  code.append('#endif')
+  code.append('')
+
+  # layer options
+  code.append('// image layer options')
+  code.append('static const int input_size = {:d};'.format(input_size))
+  code.append('static const int unit_size = {:d};'.format(unit_size))
+  code.append('static const int max_image_size = {:d};'.format(max_image_size))
+  code.append('')
+  code.append('// array arguments of layers, e.g., proposal anchors')
+  for func_name, args in specs:
+    for i, value in enumerate(args):
+      if array_args.has_key((func_name, i)):
+        table_name = '{:s}_{:s}'.format(c_name(args[0]), array_args[(func_name, i)])
+        code.append(c_array(value, table_name))
+  code.append('')
+
+  # parameter table
+  code.append('// parameter tensors, and their byte offsets in weight blob')
+  code.append('static const struct { const char* name; long int offset; }')
+  code.append('param_table[NUM_PARAMS] = {')
+  for name in params:
+    offset = offsets[name] if offsets is not None else -1
+    code.append('  {{ "{:s}", {:d} }},'.format(name, offset))
+  code.append('};')
+  code.append('')
+
+  # weight blob
+  blob_name = '{:s}_weights'.format(model_name)
+  if weight_file is not None:
+    code.append('// weight blob, packed parameter file embedded at build time')
+    code.append('#ifdef GPU')
+    code.append('#error "Embedded weights are supported in CPU mode only"')
+    code.append('#endif')
+    code.append('__asm__(".section .rodata\\n"')
+    code.append('        ".balign 64\\n"')
+    code.append('        ".global {:s}\\n"'.format(blob_name))
+    code.append('        "{:s}:\\n"'.format(blob_name))
+    code.append('        ".incbin \\"{:s}\\"\\n"'.format(os.path.abspath(weight_file)))
+    code.append('        ".previous\\n");')
+    code.append('#ifdef __cplusplus')
+    code.append('extern "C" {')
+    code.append('#endif')
+    code.append('extern const char {:s}[];'.format(blob_name))
+    code.append('#ifdef __cplusplus')
+    code.append('}')
+    code.append('#endif')
+    code.append('')
+
+  # layers
+  code.append('void setup_{:s}(Net* const net)'.format(model_name))
+  code.append('{')
+  for func_name, args in specs:
+    arg_strs = ['net']
+    for i, value in enumerate(args):
+      if array_args.has_key((func_name, i)):
+        arg_strs.append('{:s}_{:s}'.format(c_name(args[0]), array_args[(func_name, i)]))
+      elif func_name == 'add_image_layer' and i >= 3:
+        arg_strs.append(['input_size', 'unit_size', 'max_image_size'][i - 3])
+      else:
+        arg_strs.append(c_literal(value))
+    code.append('  {:s}({:s});'.format(func_name, ', '.join(arg_strs)))
+  code.append('}')
+  code.append('')
+
+  # network creator
+  code.append('Net* create_{:s}(const char* const param_path)'.format(model_name))
+  code.append('{')
+  code.append('  Net* net = create_empty_net();')
+  code.append('  if (param_path) {')
+  code.append('    strcpy(net->param_path, param_path);')
+  code.append('  }')
+  code.append('')
+  code.append('  setup_{:s}(net);'.format(model_name))
+  code.append('  if (net->num_layers != NUM_LAYERS || net->num_tensors != NUM_TENSORS) {')
+  code.append('    printf("[ERROR] Network structure differs from tables: %d layers, %d tensors\\n",')
+  code.append('           net->num_layers, net->num_tensors);')
+  code.append('  }')
+  if weight_file is not None:
+    code.append('')
+    code.append('  // parameter tensors refer to weight blob without copying')
+    code.append('  for (int i = 0; i < NUM_PARAMS; ++i) {')
+    code.append('    Tensor* const tensor = get_tensor_by_name(net, param_table[i].name);')
+    code.append('    tensor->data = (real*)({:s} + param_table[i].offset);'.format(blob_name))
+    code.append('    tensor->data_type = SHARED_PARAM_DATA;')
+    code.append('  }')
+  code.append('')
+  code.append('  malloc_net(net);')
+  code.append('')
+  code.append('  return net;')
+  code.append('}')
+  return '\n'.join(code) + '\n'
+
+def parse_args():
+  import sys, argparse
+  parser = argparse.ArgumentParser(description='C code generator for prototxt')
+  parser.add_argument('proto_name',
+                      help='prototxt filename')
+  parser.add_argument('output',
+                      help='output C source filename')
+  parser.add_argument('--name', dest='model_name',
+                      help='suffix of generated functions (default: prototxt name)',
+                      default=None, type=str)
+  parser.add_argument('--param_path', dest='param_path',
+                      help='directory of .bin files or packed parameter file',
+                      default=None, type=str)
+  parser.add_argument('--weights', dest='weights',
+                      help='write parameters (with param transforms applied) '
+                           'to this directory or .pack file',
+                      default=None, type=str)
+  parser.add_argument('--embed', dest='embed',
+                      help='embed packed parameter file (--weights *.pack) into binary',
+                      action='store_true')
+  if len(sys.argv) == 1:
+    parser.print_help()
+    sys.exit(1)
+  args = parser.parse_args()
+  return args
+
+if __name__ == "__main__":
+  args = parse_args()
+  offsets = None
+  if args.weights is not None:
+    specs = load_spec(args.proto_name)
+    offsets = save_params(specs, args.param_path, args.weights)
+  if args.embed and offsets is None:
+    print '[ERROR] --embed requires --param_path and --weights *.pack'
+  else:
+    f = open(args.output, 'w')
+    f.write(generate_code(args.proto_name, args.model_name,
+                          weight_file=args.weights if args.embed else None,
+                          offsets=offsets))
+    f.close()
@@ -0,0 +1,329 @@
+import math
+from loader import load_proto, select_layers, optimize_layers
+from loader import input_size, unit_size, max_image_size
+from pvanet import scaled_size
+
+# bytes per element of activations & parameters
+real_size = 4
+
+def _count(shape):
+  count = 1
+  for dim in shape:
+    count *= dim
+  return count
+
+def _check_shapes(layer, bottoms, axis=None):
+  # bottoms of Concat & Eltwise must agree in all dimensions except axis
+  #   e.g., an input size not resized as in image layer gives 37 x 62
+  #   and 38 x 64 maps in the two branches of a hyper-feature concat
+  def other_dims(shape):
+    return tuple([dim for i, dim in enumerate(shape) if i != axis])
+  for bottom in bottoms[1:]:
+    if len(bottom) != len(bottoms[0]) or other_dims(bottom) != other_dims(bottoms[0]):
+      raise ValueError('Layer {:s}: bottom shapes {:s} do not agree' \
+                       .format(layer.name, str(bottoms)))
+
+def _proposal_option(layer):
+  # post_nms_topn of a proposal layer (Python ProposalLayer or Proposal)
+  if layer.type == 'Proposal':
+    return layer.proposal_param.post_nms_topn
+  #   param_str is a dict, or a YAML-style list of "'key': value"
+  param_str = layer.python_param.param_str.strip()
+  if len(param_str) == 0:
+    option = {}
+  elif param_str.startswith('{'):
+    option = eval(param_str)
+  else:
+    option = eval('{' + param_str + '}')
+  return option['post_nms_topn'] if option.has_key('post_nms_topn') else 300
+
+def _reshape(bottom_shape, dims):
+  # same as reshape_shape in dl/src/layers/reshape.cu
+  #   dims: shape without batch dimension
+  #   0: copy the dimension of bottom, -1: inferred from the others
+  shape = []
+  flatten_index = -1
+  for i, dim in enumerate(dims):
+    if dim > 0:
+      shape.append(dim)
+    elif dim == 0:
+      shape.append(bottom_shape[i])
+    else:
+      shape.append(1)
+      flatten_index = i
+  if flatten_index >= 0:
+    shape[flatten_index] = _count(bottom_shape) / _count(shape)
+  return tuple(shape)
+
+def infer_layer(layer, shapes):
+  # output shapes and costs of a layer, given input shapes
+  #   shapes: dict: tensor name -> shape (without batch dimension)
+  #   return (list of top shapes, MACs, number of parameters)
+  bottoms = [shapes[name] for name in layer.bottom]
+  macs = 0
+  num_params = 0
+
+  if layer.type == 'Convolution' or layer.type == 'Deconvolution':
+    option = layer.convolution_param
+    group = option.group if option.group > 0 else 1
+    kernel_h = max(option.kernel_h, option.kernel_size)
+    kernel_w = max(option.kernel_w, option.kernel_size)
+    stride_h = max(option.stride_h, option.stride, 1)
+    stride_w = max(option.stride_w, option.stride, 1)
+    pad_h = max(option.pad_h, option.pad)
+    pad_w = max(option.pad_w, option.pad)
+    C, H, W = bottoms[0]
+    if layer.type == 'Convolution':
+      top_H = 1 + (H + 2 * pad_h - kernel_h) / stride_h
+      top_W = 1 + (W + 2 * pad_w - kernel_w) / stride_w
+      macs = option.num_output * top_H * top_W * (C / group) * kernel_h * kernel_w
+    else:
+      top_H = stride_h * (H - 1) - 2 * pad_h + kernel_h
+      top_W = stride_w * (W - 1) - 2 * pad_w + kernel_w
+      macs = C * H * W * (option.num_output / group) * kernel_h * kernel_w
+    num_params = option.num_output * (C / group) * kernel_h * kernel_w
+    if option.bias_term:
+      num_params += option.num_output
+    tops = [(option.num_output, top_H, top_W)]
+
+  elif layer.type == 'InnerProduct':
+    option = layer.inner_product_param
+    shape = bottoms[0]
+    N = shape[0] if len(shape) > 1 else 1
+    D = _count(shape[1:]) if len(shape) > 1 else shape[0]
+    macs = N * D * option.num_output
+    num_params = D * option.num_output
+    if option.bias_term:
+      num_params += option.num_output
+    tops = [(N, option.num_output)]
+
+  elif layer.type == 'Pooling':
+    option = layer.pooling_param
+    C, H, W = bottoms[0]
+    if option.global_pooling:
+      tops = [(C, 1, 1)]
+    else:
+      kernel_h = max(option.kernel_h, option.kernel_size)
+      kernel_w = max(option.kernel_w, option.kernel_size)
+      stride_h = max(option.stride_h, option.stride, 1)
+      stride_w = max(option.stride_w, option.stride, 1)
+      pad_h = max(option.pad_h, option.pad)
+      pad_w = max(option.pad_w, option.pad)
+      top_H = 1 + int(math.ceil(float(H + 2 * pad_h - kernel_h) / stride_h))
+      top_W = 1 + int(math.ceil(float(W + 2 * pad_w - kernel_w) / stride_w))
+      tops = [(C, top_H, top_W)]
+
+  elif layer.type == 'Concat':
+    axis = max(0, layer.concat_param.axis - 1)
+    _check_shapes(layer, bottoms, axis)
+    shape = list(bottoms[0])
+    shape[axis] = sum([bottom[axis] for bottom in bottoms])
+    tops = [tuple(shape)]
+
+  elif layer.type == 'Reshape':
+    dims = list(layer.reshape_param.shape.dim)
+    if len(dims) > 0 and dims[0] == 0:
+      dims = dims[1:]
+    tops = [_reshape(bottoms[0], dims)]
+
+  elif layer.type == 'Proposal' or \
+       (layer.type == 'Python' and layer.python_param.layer == 'ProposalLayer'):
+    tops = [(_proposal_option(layer), 5)]
+
+  elif layer.type == 'ROIPooling':
+    option = layer.roi_pooling_param
+    C = bottoms[0][0]
+    R = bottoms[1][0]
+    tops = [(R, C * option.pooled_h * option.pooled_w)]
+
+  elif layer.type == 'Scale':
+    C = bottoms[0][0]
+    num_params = C * (2 if layer.scale_param.bias_term else 1)
+    tops = [bottoms[0]]
+
+  elif layer.type == 'BatchNorm':
+    num_params = 2 * bottoms[0][0] + 1
+    tops = [bottoms[0]]
+
+  elif layer.type == 'Eltwise':
+    _check_shapes(layer, bottoms)
+    tops = [bottoms[0]]
+
+  elif layer.type in ['ReLU', 'Power', 'Dropout', 'Softmax']:
+    tops = [bottoms[0]]
+
+  else:
+    print '[WARNING] Unknown type {:s} of layer {:s}, ' \
+          'assumed to keep input shape'.format(layer.type, layer.name)
+    tops = [bottoms[0] if len(bottoms) > 0 else ()] * len(layer.top)
+
+  return (tops, macs, num_params)
+
+def infer_cost(proto, height=None, width=None, phase=1, optimize=True):
+  # static shapes & costs of all layers in proto (caffe_pb2.NetParameter)
+  #   input image: height x width if given, otherwise the largest input
+  #   of image layer: a raw image of input_size x (10/6 * input_size),
+  #   resized to multiples of unit_size (see scaled_size)
+  #   optimize: if True, layers are rewritten as in parse_proto
+  #             (BatchNorm folding, ReLU fusion, ...)
+  #   return a list of per-layer records (dict):
+  #     name, type, bottoms, tops, shapes (of tops), in_place (for each top),
+  #     macs, param_bytes, top_bytes (newly allocated), temp_bytes
+  if height is None or width is None:
+    height, width = scaled_size(input_size, input_size * 10 / 6, input_size, unit_size)
+
+  if optimize:
+    layers = optimize_layers(proto, phase, verbose=False)[0]
+  else:
+    layers = select_layers(proto, phase)
+
+  records = []
+  shapes = {}
+  def add_record(name, layer_type, bottoms, tops, top_shapes, macs, num_params, temp_bytes):
+    in_place = [top in bottoms for top in tops]
+    for top, shape in zip(tops, top_shapes):
+      shapes[top] = tuple(shape)
+    records.append({
+      'name': name,
+      'type': layer_type,
+      'bottoms': bottoms,
+      'tops': tops,
+      'shapes': [tuple(shape) for shape in top_shapes],
+      'in_place': in_place,
+      'macs': macs,
+      'param_bytes': num_params * real_size,
+      'top_bytes': sum([_count(shape) * real_size \
+                        for shape, flag in zip(top_shapes, in_place) if not flag]),
+      'temp_bytes': temp_bytes,
+    })
+
+  # image & image info (see image_shape in dl/src/layers/image.cu)
+  #   network inputs given by "input: " fields are treated as image layer
+  #   other outputs of data layers (e.g., labels) are of shape (1,)
+  image_shapes = [(3, height, width), (6,), (1,), (1,), (1,)]
+  image_temp_bytes = 3 * max_image_size * max_image_size * real_size
+  if len(proto.input) > 0:
+    tops = [str(name) for name in proto.input]
+    add_record('input', 'Input', [], tops, image_shapes[:len(tops)],
+               0, 0, image_temp_bytes)
+
+  for layer in layers:
+    bottoms = [str(name) for name in layer.bottom]
+    tops = [str(name) for name in layer.top]
+    if len(bottoms) == 0:
+      # data layers (DummyData, Data, Python, ...) are treated as image layer
+      add_record(str(layer.name), str(layer.type), bottoms, tops,
+                 image_shapes[:len(tops)], 0, 0, image_temp_bytes)
+    else:
+      top_shapes, macs, num_params = infer_layer(layer, shapes)
+      add_record(str(layer.name), str(layer.type), bottoms, tops,
+                 top_shapes, macs, num_params, 0)
+
+  # output layer added by parse_proto: (num_rois * num_classes) x 6 at most
+  bottoms = ['cls_prob', 'bbox_pred', 'rois', 'im_info']
+  if all([shapes.has_key(name) for name in bottoms]):
+    num_boxes = shapes['rois'][0] * shapes['cls_prob'][-1]
+    add_record('out', 'ODOut', bottoms, ['out'], [(num_boxes, 6)], 0, 0, 0)
+  return records
+
+def peak_memory(records):
+  # peak of live activation bytes over forward pass
+  #   a tensor is live from the layer producing it to the last layer
+  #   reading it, and outputs never read are live until the end
+  #   in-place outputs reuse the buffer of their inputs
+  #   return (peak bytes, name of layer at the peak)
+  buffers = []
+  current = {}
+  for i, record in enumerate(records):
+    for name in record['bottoms']:
+      if current.has_key(name):
+        current[name][2] = i
+    for name, shape, in_place in zip(record['tops'], record['shapes'], record['in_place']):
+      if in_place and current.has_key(name):
+        current[name][2] = i
+        continue
+      buf = [_count(shape) * real_size, i, i]
+      buffers.append(buf)
+      current[name] = buf
+  last = len(records) - 1
+  for buf in current.values():
+    if buf[2] == buf[1]:
+      buf[2] = last
+
+  peak, peak_index = 0, 0
+  for i in range(len(records)):
+    live = sum([size for size, start, end in buffers if start <= i <= end])
+    if live > peak:
+      peak, peak_index = live, i
+  return (peak, records[peak_index]['name'] if len(records) > 0 else None)
+
+def summarize(records):
+  # dict of totals: layers, macs, param_bytes, top_bytes, peak_bytes, peak_layer
+  peak_bytes, peak_layer = peak_memory(records)
+  return {
+    'layers': len(records),
+    'macs': sum([record['macs'] for record in records]),
+    'param_bytes': sum([record['param_bytes'] for record in records]),
+    'top_bytes': sum([record['top_bytes'] for record in records]),
+    'peak_bytes': peak_bytes,
+    'peak_layer': peak_layer,
+  }
+
+def show_cost(records):
+  print '{:32s} {:14s} {:>18s} {:>10s} {:>10s} {:>10s}'.format( \
+        'name', 'type', 'shape', 'MMACs', 'param KB', 'top KB')
+  for record in records:
+    shape = 'x'.join([str(dim) for dim in record['shapes'][0]]) \
+            if len(record['shapes']) > 0 else ''
+    print '{:32s} {:14s} {:>18s} {:10.2f} {:10.1f} {:10.1f}'.format( \
+          record['name'][:32], record['type'][:14], shape,
+          record['macs'] / 1e6, record['param_bytes'] / 1e3,
+          record['top_bytes'] / 1e3)
+  total = summarize(records)
+  print 'Total: {:d} layers, {:.3f} GMACs, parameters {:.2f}MB, ' \
+        'activations {:.2f}MB, peak live {:.2f}MB (at {:s})'.format( \
+        total['layers'], total['macs'] / 1e9, total['param_bytes'] / 1e6,
+        total['top_bytes'] / 1e6, total['peak_bytes'] / 1e6, total['peak_layer'])
+
+def compare_costs(proto_names, height=None, width=None, optimize=True):
+  # one line of totals for each prototxt, e.g., for variants under pvanet/
+  print '{:48s} {:>7s} {:>8s} {:>10s} {:>10s}'.format( \
+        'prototxt', 'layers', 'GMACs', 'param MB', 'peak MB')
+  for proto_name in proto_names:
+    try:
+      records = infer_cost(load_proto(proto_name), height, width, optimize=optimize)
+    except Exception as e:
+      print '[ERROR] {:s}: {:s}'.format(proto_name, str(e).split('\n')[0])
+      continue
+    total = summarize(records)
+    print '{:48s} {:7d} {:8.3f} {:10.2f} {:10.2f}'.format( \
+          proto_name[-48:], total['layers'], total['macs'] / 1e9,
+          total['param_bytes'] / 1e6, total['peak_bytes'] / 1e6)
+
+def parse_args():
+  import sys, argparse
+  parser = argparse.ArgumentParser(description='Static shape & cost inference for prototxt')
+  parser.add_argument('proto_names', nargs='+',
+                      help='prototxt filenames')
+  parser.add_argument('--raw_size', dest='raw_size',
+                      help='raw image size (height, width), resized as in image layer',
+                      default=None, type=int, nargs=2)
+  parser.add_argument('--no_optimize', dest='optimize',
+                      help='do not apply graph optimization passes',
+                      action='store_false')
+  if len(sys.argv) == 1:
+    parser.print_help()
+    sys.exit(1)
+  args = parser.parse_args()
+  return args
+
+if __name__ == "__main__":
+  args = parse_args()
+  height, width = (None, None)
+  if args.raw_size:
+    height, width = scaled_size(args.raw_size[0], args.raw_size[1], input_size, unit_size)
+  if len(args.proto_names) == 1:
+    show_cost(infer_cost(load_proto(args.proto_names[0]), height, width,
+                         optimize=args.optimize))
+  else:
+    compare_costs(args.proto_names, height, width, optimize=args.optimize)
@@ -1,10 +1,60 @@
-from proto import caffe_pb2
-from google.protobuf import text_format
 import ctypes
+import os
+import hashlib
+import marshal
 from pvanet import lib as pvalib
-from pvanet import detect, get_tensor_data
+from pvanet import detect, detect_batch, get_tensor_data, DetectorPool, DetectionTimeout
+from pvanet import share_params, map_tensor_data, check_tensor_data, free_net, PRIVATE_DATA
+from packfile import read_pack
 
-def parse_layer(layer, phase=1, verbose=False, net=None):
+# directory for compiled network specs, see load_spec
+#   None (default) disables the cache, set PVANET_SPEC_CACHE to enable it
+spec_cache_dir = os.environ.get('PVANET_SPEC_CACHE') or None
+
+# options of image layer (DummyData in prototxt)
+#   input_size: shorter side of resized input image
+#               (longer side <= 10/6 * input_size)
+#   unit_size: height & width of resized image are multiples of unit_size
+#   max_image_size: maximum height & width of raw image
+input_size = 600
+unit_size = 32
+max_image_size = 2048
+
+# format version of compiled specs
+#   bump whenever parse_proto emits different specs for the same prototxt
+spec_version = 3
+
+# specs applied to parameters while loading them, see fold_params
+param_transforms = ['fold_bn', 'fold_scale', 'fold_power']
+
+def build_layer(net, spec):
+  # add a layer to net according to spec = (layer creator name, arguments)
+  #   list arguments are converted to C arrays
+  #   param_transforms are skipped here
+  def string_array(names):
+    name_len = pvalib._max_name_len()
+    buffers = [ctypes.create_string_buffer(name_len) for i in range(len(names))]
+    for buf, name in zip(buffers, names):
+      buf[:len(name)] = name[:]
+      buf[len(name)] = '\0'
+    pointers = (ctypes.c_char_p * len(names))(*map(ctypes.addressof, buffers))
+    return (pointers, buffers)
+
+  func_name, args = spec
+  if func_name in param_transforms:
+    return
+  args = list(args)
+  buffers = None
+  if func_name in ['add_concat_layer', 'add_eltwise_layer']:
+    args[1], buffers = string_array(args[1])
+  elif func_name == 'add_reshape_layer':
+    args[3] = (ctypes.c_int * len(args[3]))(*args[3])
+  elif func_name == 'add_proposal_layer':
+    args[5] = (ctypes.c_float * len(args[5]))(*args[5])
+    args[7] = (ctypes.c_float * len(args[7]))(*args[7])
+  getattr(pvalib, func_name)(net, *args)
+
+def parse_layer(layer, phase=1, verbose=False, net=None, specs=None, fused=None):
   def convert_name(name):
     if len(name) == 0:
       return None
@@ -42,6 +92,7 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
 
   generate = True if net is not None else False
   command = ''
+  spec = None
 
   layer_name = convert_name(layer.name)
   bottom_names = convert_names(layer.bottom)
@@ -55,13 +106,9 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
     print '  param: {:s}'.format(param_names)
 
   if layer.type == 'DummyData':
-    input_size = 600
-    unit_size = 32
-    max_image_size = 2048
     command = 'add_image_layer(net, "{:s}", "{:s}", "{:s}", {:d}, {:d}, {:d});'.format( \
               layer_name, top_names[0], top_names[1], input_size, unit_size, max_image_size)
-    if generate:
-      pvalib.add_image_layer(net, layer_name, top_names[0], top_names[1], input_size, unit_size, max_image_size)
+    spec = ('add_image_layer', (layer_name, top_names[0], top_names[1], input_size, unit_size, max_image_size))
 
   elif layer.type == 'Convolution' or layer.type == 'Deconvolution':
     option = layer.convolution_param
@@ -78,14 +125,13 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
               layer_name, bottom_names[0], top_names[0], group, num_output,
               kernel_h, kernel_w, stride_h, stride_w, pad_h, pad_w,
               bias_term)
+    args = (layer_name, bottom_names[0], top_names[0], None, None, group, num_output, kernel_h, kernel_w, stride_h, stride_w, pad_h, pad_w, bias_term)
     if layer.type == 'Convolution':
       command = 'add_conv_layer{:s}'.format(arg_str)
-      if generate:
-        pvalib.add_conv_layer(net, layer_name, bottom_names[0], top_names[0], None, None, group, num_output, kernel_h, kernel_w, stride_h, stride_w, pad_h, pad_w, bias_term)
+      spec = ('add_conv_layer', args)
     else:
       command = 'add_deconv_layer{:s}'.format(arg_str)
-      if generate:
-        pvalib.add_deconv_layer(net, layer_name, bottom_names[0], top_names[0], None, None, group, num_output, kernel_h, kernel_w, stride_h, stride_w, pad_h, pad_w, bias_term)
+      spec = ('add_deconv_layer', args)
 
   elif layer.type == 'Power':
     option = layer.power_param
@@ -94,8 +140,7 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
     order = float(option.power)
     command = 'add_power_layer(net, "{:s}", "{:s}", "{:s}", {:f}f, {:f}f, {:f}f, 1);'.format( \
               layer_name, bottom_names[0], top_names[0], weight, bias, order)
-    if generate:
-      pvalib.add_power_layer(net, layer_name, bottom_names[0], top_names[0], weight, bias, order, 1)
+    spec = ('add_power_layer', (layer_name, bottom_names[0], top_names[0], weight, bias, order, 1))
 
   elif layer.type == 'Concat':
     command += '{ '
@@ -103,20 +148,12 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
     command += 'add_concat_layer(net, "{:s}", names, "{:s}", {:d}); '.format( \
                layer_name, top_names[0], len(bottom_names))
     command += '}'
-    if generate:
-      name_len = pvalib._max_name_len()
-      buffers = [ctypes.create_string_buffer(name_len) for i in range(len(bottom_names))]
-      for buf, name in zip(buffers, bottom_names):
-        buf[:len(name)] = name[:]
-        buf[len(name)] = '\0'
-      pointers = (ctypes.c_char_p * len(bottom_names))(*map(ctypes.addressof, buffers))
-      pvalib.add_concat_layer(net, layer_name, pointers, top_names[0], len(bottom_names))
+    spec = ('add_concat_layer', (layer_name, bottom_names, top_names[0], len(bottom_names)))
 
   elif layer.type == 'ReLU':
     command = 'add_relu_layer(net, "{:s}", "{:s}", "{:s}", 0);'.format( \
               layer_name, bottom_names[0], top_names[0])
-    if generate:
-      pvalib.add_relu_layer(net, layer_name, bottom_names[0], top_names[0], 0)
+    spec = ('add_relu_layer', (layer_name, bottom_names[0], top_names[0], 0))
 
   elif layer.type == 'Pooling':
     option = layer.pooling_param
@@ -130,16 +167,14 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
               layer_name, bottom_names[0], top_names[0],
               kernel_h, kernel_w, stride_h, stride_w, pad_h, pad_w)
     command = 'add_pool_layer{:s}'.format(arg_str)
-    if generate:
-      pvalib.add_pool_layer(net, layer_name, bottom_names[0], top_names[0], kernel_h, kernel_w, stride_h, stride_w, pad_h, pad_w)
+    spec = ('add_pool_layer', (layer_name, bottom_names[0], top_names[0], kernel_h, kernel_w, stride_h, stride_w, pad_h, pad_w))
 
   elif layer.type == 'Scale':
     option = layer.scale_param
     bias_term = option.bias_term
     command = 'add_scale_layer(net, "{:s}", "{:s}", "{:s}", NULL, NULL, {:d});'.format( \
               layer_name, bottom_names[0], top_names[0], bias_term)
-    if generate:
-      pvalib.add_scale_layer(net, layer_name, bottom_names[0], top_names[0], None, None, bias_term)
+    spec = ('add_scale_layer', (layer_name, bottom_names[0], top_names[0], None, None, bias_term))
 
   elif layer.type == 'Eltwise':
     command += '{ '
@@ -147,14 +182,7 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
     command += 'add_eltwise_layer(net, "{:s}", names, "{:s}", {:d}); '.format( \
                layer_name, top_names[0], len(bottom_names))
     command += '}'
-    if generate:
-      name_len = pvalib._max_name_len()
-      buffers = [ctypes.create_string_buffer(name_len) for i in range(len(bottom_names))]
-      for buf, name in zip(buffers, bottom_names):
-        buf[:len(name)] = name[:]
-        buf[len(name)] = '\0'
-      pointers = (ctypes.c_char_p * len(bottom_names))(*map(ctypes.addressof, buffers))
-      pvalib.add_eltwise_layer(net, layer_name, pointers, top_names[0], len(bottom_names))
+    spec = ('add_eltwise_layer', (layer_name, bottom_names, top_names[0], len(bottom_names)))
 
   elif layer.type == 'Reshape':
     option = layer.reshape_param
@@ -166,19 +194,14 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
     command += 'add_reshape_layer(net, "{:s}", "{:s}", "{:s}", list, {:d}); '.format( \
                layer_name, bottom_names[0], top_names[0], len(shape))
     command += '}'
-    if generate:
-      ary = (ctypes.c_int * len(shape))()
-      for i, elem in enumerate(shape):
-        ary[i] = elem
-      pvalib.add_reshape_layer(net, layer_name, bottom_names[0], top_names[0], ary, len(shape))
+    spec = ('add_reshape_layer', (layer_name, bottom_names[0], top_names[0], [int(elem) for elem in shape], len(shape)))
 
   elif layer.type == 'Softmax':
     option = layer.softmax_param
     axis = max(0, option.axis - 1)
     command = 'add_softmax_layer(net, "{:s}", "{:s}", "{:s}", {:d});'.format( \
               layer_name, bottom_names[0], top_names[0], axis)
-    if generate:
-      pvalib.add_softmax_layer(net, layer_name, bottom_names[0], top_names[0], axis)
+    spec = ('add_softmax_layer', (layer_name, bottom_names[0], top_names[0], axis))
 
   elif layer.type == 'Python' and layer.python_param.layer == 'ProposalLayer':
     option = eval(layer.python_param.param_str)
@@ -199,14 +222,7 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
                layer_name, bottom_names[0], bottom_names[1], bottom_names[2], top_names[0])
     command += 'scales, {:d}, ratios, {:d}, {:d}, {:d}, {:d}, {:d}, {:d}, {:f}f, {:d}, {:f}f); '.format(len(scales), len(ratios), feat_stride, base_size, min_size, pre_nms_topn, post_nms_topn, nms_thresh, bbox_vote, vote_thresh)
     command += '}'
-    if generate:
-      scales_ary = (ctypes.c_float * len(scales))()
-      for i, elem in enumerate(scales):
-        scales_ary[i] = elem
-      ratios_ary = (ctypes.c_float * len(ratios))()
-      for i, elem in enumerate(ratios):
-        ratios_ary[i] = elem
-      pvalib.add_proposal_layer(net, layer_name, bottom_names[0], bottom_names[1], bottom_names[2], top_names[0], scales_ary, len(scales), ratios_ary, len(ratios), feat_stride, base_size, min_size, pre_nms_topn, post_nms_topn, nms_thresh, bbox_vote, vote_thresh)
+    spec = ('add_proposal_layer', (layer_name, bottom_names[0], bottom_names[1], bottom_names[2], top_names[0], [float(elem) for elem in scales], len(scales), [float(elem) for elem in ratios], len(ratios), feat_stride, base_size, min_size, pre_nms_topn, post_nms_topn, nms_thresh, bbox_vote, vote_thresh))
 
   elif layer.type == 'ROIPooling':
     option = layer.roi_pooling_param
@@ -218,8 +234,7 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
               layer_name, bottom_names[0], bottom_names[1], top_names[0])
     command += '{:d}, {:d}, {:f}f, {:d});'.format( \
                pooled_h, pooled_w, spatial_scale, flatten)
-    if generate:
-      pvalib.add_roipool_layer(net, layer_name, bottom_names[0], bottom_names[1], top_names[0], pooled_h, pooled_w, spatial_scale, flatten)
+    spec = ('add_roipool_layer', (layer_name, bottom_names[0], bottom_names[1], top_names[0], pooled_h, pooled_w, spatial_scale, flatten))
 
   elif layer.type == 'InnerProduct':
     option = layer.inner_product_param
@@ -227,8 +242,7 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
     bias_term = option.bias_term
     command = 'add_fc_layer(net, "{:s}", "{:s}", "{:s}", NULL, NULL, {:d}, {:d});'.format( \
               layer_name, bottom_names[0], top_names[0], num_output, bias_term)
-    if generate:
-      pvalib.add_fc_layer(net, layer_name, bottom_names[0], top_names[0], None, None, num_output, bias_term)
+    spec = ('add_fc_layer', (layer_name, bottom_names[0], top_names[0], None, None, num_output, bias_term))
 
   elif layer.type == 'Dropout':
     option = layer.dropout_param
@@ -236,55 +250,546 @@ def parse_layer(layer, phase=1, verbose=False, net=None):
     scale_train = option.scale_train
     command = 'add_dropout_layer(net, "{:s}", "{:s}", "{:s}", {:f}f, 1, {:d});'.format( \
               layer_name, bottom_names[0], top_names[0], dropout_ratio, scale_train)
+    spec = ('add_dropout_layer', (layer_name, bottom_names[0], top_names[0], dropout_ratio, 1, int(scale_train)))
 
   else:
     print 'Undefined type: {:s}, {:s}'.format(layer_name, layer.type)
+
+  layer_specs = [spec] if spec is not None else []
+
+  # operations fused into this layer by optimize_layers
+  if fused is not None:
+    for fold in fused.get('folds', []):
+      if fold[0] == 'bn':
+        command += ' // fold_bn: {:s} <- {:s}'.format(layer_name, ' + '.join([elem for elem in fold[1:3] if elem]))
+        layer_specs.append(('fold_bn', (layer_name,) + tuple(fold[1:])))
+      elif fold[0] == 'scale':
+        command += ' // fold_scale: {:s} <- {:s}'.format(layer_name, fold[1])
+        layer_specs.append(('fold_scale', (layer_name, fold[1], fold[2])))
+      else:
+        command += ' // fold_power: {:s} <- {:f} * x + {:f}'.format(layer_name, fold[1], fold[2])
+        layer_specs.append(('fold_power', (layer_name, fold[1], fold[2])))
+    if fused.has_key('relu'):
+      command += ' fuse_relu_layer(net, "{:s}", {:f}f);'.format( \
+                 layer_name, fused['relu'])
+      layer_specs.append(('fuse_relu_layer', (layer_name, fused['relu'])))
+
+  for spec in layer_specs:
+    if specs is not None:
+      specs.append(spec)
+    if generate:
+      build_layer(net, spec)
   return command
 
-def parse_proto(proto, phase=1, net=None):
+def _copy_layer(layer):
+  copied = type(layer)()
+  copied.CopyFrom(layer)
+  return copied
+
+def _find_producer(layers, j, name):
+  # index of the last layer before layers[j] that outputs name, or -1
+  for i in range(j - 1, -1, -1):
+    if name in layers[i].top:
+      return i
+  return -1
+
+def _is_exclusive(layers, i, j):
+  # True if output of layers[i] is read by no layer other than layers[j]
+  # until it is overwritten
+  name = layers[i].top[0]
+  for k in range(i + 1, len(layers)):
+    if k == j:
+      if layers[j].top[0] == name:
+        return True
+      continue
+    if name in layers[k].bottom:
+      return False
+    if name in layers[k].top:
+      return True
+  return True
+
+def _merge_into_producer(layers, i, j):
+  # remove layers[j] whose role is taken over by its producer layers[i]
+  if layers[j].top[0] != layers[i].top[0]:
+    layers[i].top[0] = layers[j].top[0]
+  del layers[j]
+
+def _fold_batchnorm(layers, fused, log):
+  # fold BatchNorm, and Scale right after BatchNorm, into preceding conv or fc
+  #   parameters are transformed while loading, see fold_params
+  #   BatchNorm not right after conv or fc is removed as before,
+  #   assuming that it is already combined offline
+  j = 0
+  while j < len(layers):
+    layer = layers[j]
+    if layer.type != 'BatchNorm':
+      j += 1
+      continue
+    scale = None
+    if j + 1 < len(layers) and layers[j + 1].type == 'Scale' \
+       and layers[j + 1].bottom[0] == layer.top[0]:
+      scale = layers[j + 1]
+
+    i = _find_producer(layers, j, layer.bottom[0])
+    if i < 0 or layers[i].type not in ['Convolution', 'InnerProduct'] \
+       or not _is_exclusive(layers, i, j) \
+       or (scale is not None and not _is_exclusive(layers, j, j + 1)):
+      log('Remove {:s} (assumed to be combined offline)'.format(layer.name))
+      if scale is not None:
+        del layers[j + 1]
+      del layers[j]
+      continue
+
+    producer = layers[i]
+    if producer.type == 'Convolution':
+      option = producer.convolution_param
+    else:
+      option = producer.inner_product_param
+    option.bias_term = True
+    scale_name = str(scale.name).replace('/', '_') if scale is not None else ''
+    scale_bias_term = int(scale.scale_param.bias_term) if scale is not None else 0
+    fold = ('bn', str(layer.name).replace('/', '_'), scale_name,
+            scale_bias_term, int(option.num_output))
+    fused.setdefault(producer.name, {}).setdefault('folds', []).append(fold)
+    if scale is not None:
+      log('Fold {:s} + {:s} into {:s}'.format(layer.name, scale.name, producer.name))
+      _merge_into_producer(layers, j, j + 1)
+    else:
+      log('Fold {:s} into {:s}'.format(layer.name, producer.name))
+    _merge_into_producer(layers, i, j)
+
+def _remove_identity(layers, fused, log):
+  # remove test-time Dropout and Power of (scale = 1, shift = 0, power = 1)
+  #   test-time Dropout is identity if scale_train (default),
+  #   and x * (1 - dropout_ratio) otherwise, which is turned into Power
+  j = 0
+  while j < len(layers):
+    layer = layers[j]
+    if layer.type == 'Dropout' and not layer.dropout_param.scale_train:
+      layer.type = 'Power'
+      layer.power_param.scale = 1 - layer.dropout_param.dropout_ratio
+      log('Dropout {:s} -> Power'.format(layer.name))
+      j += 1
+      continue
+    if not (layer.type == 'Dropout' or (layer.type == 'Power' and \
+            layer.power_param.power == 1 and layer.power_param.scale == 1 and \
+            layer.power_param.shift == 0)):
+      j += 1
+      continue
+    bottom, top = layer.bottom[0], layer.top[0]
+    # renaming readers of top is valid only if bottom stays as it is
+    if bottom != top and any([bottom in elem.top for elem in layers[j + 1:]]):
+      j += 1
+      continue
+    for elem in layers[j + 1:]:
+      for k in range(len(elem.bottom)):
+        if elem.bottom[k] == top:
+          elem.bottom[k] = bottom
+    log('Remove {:s}'.format(layer.name))
+    del layers[j]
+
+def _fold_scale_power(layers, fused, log):
+  # fold Scale & Power (power = 1) into preceding conv or fc
+  #   parameters are transformed after loading, see fold_params
+  j = 0
+  while j < len(layers):
+    layer = layers[j]
+    if layer.type == 'Scale':
+      option = layer.scale_param
+      foldable = len(layer.bottom) == 1 and option.axis == 1 and option.num_axes == 1
+      has_bias = option.bias_term
+    elif layer.type == 'Power':
+      option = layer.power_param
+      foldable = option.power == 1
+      has_bias = option.shift != 0
+    else:
+      j += 1
+      continue
+    i = _find_producer(layers, j, layer.bottom[0])
+    if i < 0 or not foldable or not _is_exclusive(layers, i, j) \
+       or layers[i].type not in ['Convolution', 'InnerProduct']:
+      j += 1
+      continue
+    producer = layers[i]
+    if producer.type == 'Convolution':
+      bias_term = producer.convolution_param.bias_term
+    else:
+      bias_term = producer.inner_product_param.bias_term
+    if has_bias and not bias_term:
+      j += 1
+      continue
+    if layer.type == 'Scale':
+      fold = ('scale', str(layer.name).replace('/', '_'), int(has_bias))
+    else:
+      fold = ('power', float(option.scale), float(option.shift))
+    fused.setdefault(producer.name, {}).setdefault('folds', []).append(fold)
+    log('Fold {:s} into {:s}'.format(layer.name, producer.name))
+    _merge_into_producer(layers, i, j)
+
+def _fuse_relu(layers, fused, log):
+  # fuse ReLU into preceding conv or eltwise
+  j = 0
+  while j < len(layers):
+    layer = layers[j]
+    if layer.type != 'ReLU':
+      j += 1
+      continue
+    i = _find_producer(layers, j, layer.bottom[0])
+    if i < 0 or layers[i].type not in ['Convolution', 'Eltwise'] \
+       or fused.get(layers[i].name, {}).has_key('relu') \
+       or not _is_exclusive(layers, i, j):
+      j += 1
+      continue
+    fused.setdefault(layers[i].name, {})['relu'] = float(layer.relu_param.negative_slope)
+    log('Fuse {:s} into {:s}'.format(layer.name, layers[i].name))
+    _merge_into_producer(layers, i, j)
+
+def _collapse_reshape(layers, fused, log):
+  # Reshape -> Reshape = the latter Reshape only,
+  # unless the latter copies some dimensions (0) from its input
+  j = 0
+  while j < len(layers):
+    layer = layers[j]
+    if layer.type != 'Reshape' or 0 in layer.reshape_param.shape.dim[1:]:
+      j += 1
+      continue
+    i = _find_producer(layers, j, layer.bottom[0])
+    if i < 0 or layers[i].type != 'Reshape' or not _is_exclusive(layers, i, j) \
+       or any([layers[i].bottom[0] in elem.top for elem in layers[i + 1:j]]):
+      j += 1
+      continue
+    log('Collapse {:s} + {:s}'.format(layers[i].name, layer.name))
+    layer.bottom[0] = layers[i].bottom[0]
+    del layers[i]
+
+# graph optimization passes, applied in order by optimize_layers
+optimization_passes = [
+  _fold_batchnorm,
+  _remove_identity,
+  _fold_scale_power,
+  _fuse_relu,
+  _collapse_reshape,
+]
+
+def select_layers(proto, phase=1, keep_bn=False):
+  # layers of proto to be built, in phase
+  #   unless keep_bn, BatchNorm, and Scale right after BatchNorm, are skipped
+  #   since they are assumed to be already combined with conv
+  #   (see dl.combine_conv_bn_scale)
   def skip(i, layer):
     if len(layer.include) > 0 and all([elem.phase != phase for elem in layer.include]):
       return True
+    if keep_bn:
+      return False
     if layer.type in ['BatchNorm']:
       return True
     if layer.type == 'Scale' and i > 0 and proto.layer[i - 1].type == 'BatchNorm':
       return True
     return False
 
+  return [_copy_layer(layer) for i, layer in enumerate(proto.layer) \
+          if not skip(i, layer)]
+
+def optimize_layers(proto, phase=1, verbose=True):
+  # apply optimization_passes to layers of proto
+  #   return (list of rewritten layers,
+  #           dict: layer name -> operations fused into the layer)
+  #   fused operations: 'relu': negative slope
+  #                     'folds': list of ('bn', BatchNorm layer name,
+  #                                       Scale layer name or '',
+  #                                       Scale bias term, num_output)
+  #                              or ('scale', Scale layer name, bias term)
+  #                              or ('power', weight, bias)
+  def log(message):
+    if verbose:
+      print '[optimize] {:s}'.format(message)
+
+  layers = select_layers(proto, phase, keep_bn=True)
+  num_layers = len(layers)
+  fused = {}
+  for optimization_pass in optimization_passes:
+    optimization_pass(layers, fused, log)
+  log('{:d} -> {:d} layers'.format(num_layers, len(layers)))
+  return (layers, fused)
+
+def parse_proto(proto, phase=1, net=None, specs=None, print_code=True, optimize=True):
+  if optimize:
+    layers, fused = optimize_layers(proto, phase)
+  else:
+    layers, fused = select_layers(proto, phase), {}
+
   command = '#include "layer.h"\n\n'
   command += 'void setup_shared_cnn(Net* const net)\n{\n'
-  for i, layer in enumerate(proto.layer):
-    if not skip(i, layer):
-      command += '  {:s}\n'.format(parse_layer(layer, net=net))
+  for layer in layers:
+    command += '  {:s}\n'.format(parse_layer(layer, net=net, specs=specs,
+                                             fused=fused.get(layer.name)))
   command += '  add_odout_layer(net, "out", "cls_prob", "bbox_pred", "rois", "im_info", "out", 16, 300, 0.7f, 0.4f, 0, 0.5f);\n'
   command += '}\n'
-  print command
+  if print_code:
+    print command
 
+  spec = ('add_odout_layer', ("out", "cls_prob", "bbox_pred", "rois", "im_info", "out", 16, 300, 0.7, 0.4, 0, 0.5))
+  if specs is not None:
+    specs.append(spec)
   if net is not None:
-    pvalib.add_odout_layer(net, "out", "cls_prob", "bbox_pred", "rois", "im_info", "out", 16, 300, 0.7, 0.4, 0, 0.5)
+    build_layer(net, spec)
 
 def load_proto(proto_name):
+  from proto import caffe_pb2
+  from google.protobuf import text_format
   proto = caffe_pb2.NetParameter()
   f = open(proto_name, 'r')
   text_format.Merge(f.read(), proto)
   f.close()
   return proto
 
-def load_pva900(net=None):
+def load_spec(proto_name, phase=1, cache_dir=None):
+  # list of layer specs (see build_layer) for a prototxt
+  #   compiled specs are cached at cache_dir (default: spec_cache_dir),
+  #   keyed by content hash of the prototxt, so that later loads skip
+  #   prototxt parsing
+  #   nothing is cached if neither cache_dir nor spec_cache_dir is given
+  if cache_dir is None:
+    cache_dir = spec_cache_dir
+  f = open(proto_name, 'r')
+  text = f.read()
+  f.close()
+  cache_name = None
+  if cache_dir is not None:
+    key = hashlib.sha1(text).hexdigest()
+    cache_name = os.path.join(cache_dir, '{:s}_{:d}_{:d}_{:d}.spec'.format( \
+                              key, phase, spec_version, marshal.version))
+
+  if cache_name is not None and os.path.exists(cache_name):
+    try:
+      f = open(cache_name, 'rb')
+      specs = marshal.load(f)
+      f.close()
+      return specs
+    except (EOFError, ValueError, TypeError):
+      print '[ERROR] Broken spec cache {:s}, rebuilt'.format(cache_name)
+
+  from proto import caffe_pb2
+  from google.protobuf import text_format
+  proto = caffe_pb2.NetParameter()
+  text_format.Merge(text, proto)
+  specs = []
+  parse_proto(proto, phase=phase, specs=specs, print_code=False)
+  if cache_name is None:
+    return specs
+
+  # write to a temporary file first, so that concurrent loaders
+  # never see a partially written spec
+  try:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    temp_name = '{:s}.{:d}.tmp'.format(cache_name, os.getpid())
+    f = open(temp_name, 'wb')
+    marshal.dump(specs, f)
+    f.close()
+    os.rename(temp_name, cache_name)
+  except (IOError, OSError) as e:
+    print '[ERROR] Cannot write spec cache {:s}: {:s}'.format(cache_name, str(e))
+  return specs
+
+def build_net(net, specs):
+  for spec in specs:
+    build_layer(net, spec)
+
+def _read_bin(filename):
+  # (ndim, shape[0], ..., shape[ndim - 1], data) as written by dl.save_data
+  import numpy as np
+  f = open(filename, 'rb')
+  ndim = np.fromfile(f, dtype=np.int32, count=1)[0]
+  shape = np.fromfile(f, dtype=np.int32, count=ndim)
+  data = np.fromfile(f, dtype=np.float32).reshape(shape)
+  f.close()
+  return data
+
+def _write_bin(filename, data):
+  import numpy as np
+  f = open(filename, 'wb')
+  np.array([data.ndim] + list(data.shape), dtype=np.int32).tofile(f)
+  data.astype(np.float32).tofile(f)
+  f.close()
+
+def _fold(weight, bias, func_name, args, read):
+  # apply a param transform to (weight, bias) in double precision
+  #   read(layer_name, param_id): parameter array of a layer
+  #   returns transformed (weight, bias)
+  import numpy as np
+  def read_double(layer_name, param_id):
+    return read(layer_name, param_id).astype(np.double).ravel()
+
+  if func_name == 'fold_bn':
+    # same as dl.combine_conv_bn_scale, for all channels at once
+    layer_name, bn_name, scale_name, scale_bias_term, num_output = args
+    num_bn_samples = read_double(bn_name, 2)[0]
+    if num_bn_samples == 0:
+      num_bn_samples = 1
+    bn_mean = read_double(bn_name, 0) / num_bn_samples
+    bn_variance = read_double(bn_name, 1) / num_bn_samples
+    scale_weight = read_double(scale_name, 0) if scale_name else 1
+    scale_bias = read_double(scale_name, 1) if scale_name and scale_bias_term else 0
+    scale = scale_weight / np.sqrt(bn_variance + np.finfo(np.double).eps)
+    shift = scale_bias - bn_mean * scale
+    if bias is None:
+      bias = np.zeros((num_output,), dtype=np.double)
+  elif func_name == 'fold_scale':
+    scale = read_double(args[1], 0)
+    shift = read_double(args[1], 1) if args[2] else 0
+  else:
+    scale = np.array([args[1]], dtype=np.double)
+    shift = args[2]
+
+  # weight: (G x C') x ... for conv, C' x ... for fc
+  weight.reshape((scale.size, -1))[:] *= scale.reshape((-1, 1))
+  if bias is not None:
+    bias = bias * scale + shift
+  return (weight, bias)
+
+def _fold_all(specs, read):
+  # apply all param_transforms in specs
+  #   read(layer_name, param_id): parameter array of a layer,
+  #                               raises IOError or KeyError if not found
+  #   returns dict: layer name -> transformed (weight, bias) in double
+  import numpy as np
+  params = {}
+  for func_name, args in specs:
+    if func_name not in param_transforms:
+      continue
+    layer_name = args[0]
+    if not params.has_key(layer_name):
+      weight, bias = None, None
+      try:
+        weight = read(layer_name, 0).astype(np.double)
+        bias = read(layer_name, 1).astype(np.double).ravel()
+      except (IOError, KeyError):
+        pass
+      params[layer_name] = (weight, bias)
+    weight, bias = params[layer_name]
+    if weight is None:
+      continue
+    try:
+      params[layer_name] = _fold(weight, bias, func_name, args, read)
+    except (IOError, KeyError) as e:
+      print '[ERROR] Cannot fold parameters of {:s}: {:s}'.format(layer_name, str(e))
+      if func_name == 'fold_bn' and bias is None:
+        params[layer_name] = (weight, np.zeros((args[4],), dtype=np.double))
+  return params
+
+def fold_params(net, specs):
+  # apply param_transforms in specs to parameters of net
+  #   transformed parameters are written to a temporary directory, together
+  #   with links to all other parameter files, and net.param_path is set to
+  #   the directory so that malloc_net reads the transformed parameters
+  #   returns (original param_path, temporary directory),
+  #   or None if no param transform is given
+  #   fold_bn: BatchNorm (+ Scale) after conv or fc,
+  #            W[o] <- W[o] * alpha[o],
+  #            b[o] <- b[o] * alpha[o] + (beta[o] - mean[o] * alpha[o]),
+  #            alpha[o] = gamma[o] / sqrt(var[o] + eps)
+  #   fold_scale: W[o] <- W[o] * scale[o], b[o] <- b[o] * scale[o] + shift[o]
+  #   fold_power: W <- W * weight, b <- b * weight + bias
+  #   for each output channel o
+  import tempfile
+  param_path = os.path.abspath(net.contents.param_path)
+  if not any([spec[0] in param_transforms for spec in specs]) \
+     or not os.path.isdir(param_path):
+    return None
+
+  def read(layer_name, param_id):
+    return _read_bin('{:s}/{:s}_param{:d}.bin'.format(param_path, layer_name, param_id))
+  params = _fold_all(specs, read)
+
+  fold_dir = tempfile.mkdtemp(prefix='pvanet_params_')
+  for filename in os.listdir(param_path):
+    os.symlink(os.path.join(param_path, filename), os.path.join(fold_dir, filename))
+  for layer_name, param in params.items():
+    for i, data in enumerate(param):
+      if data is None:
+        continue
+      filename = os.path.join(fold_dir, '{:s}_param{:d}.bin'.format(layer_name, i))
+      if os.path.lexists(filename):
+        os.remove(filename)
+      _write_bin(filename, data)
+  net.contents.param_path = fold_dir
+  return (param_path, fold_dir)
+
+def map_params(net, specs):
+  # let parameter tensors of net refer to arrays in a packed parameter file
+  #   (net.param_path) without copying them
+  #   the file is memory-mapped read-only, so all processes using it share
+  #   a single copy in page cache
+  #   parameters transformed by param_transforms (see fold_params)
+  #   are kept in private memory instead
+  #   must be called after all layers are added and before malloc_net
+  import numpy as np
+  arrays = read_pack(net.contents.param_path)
+  def read(layer_name, param_id):
+    return arrays['{:s}_param{:d}'.format(layer_name, param_id)]
+  for layer_name, param in _fold_all(specs, read).items():
+    for i, data in enumerate(param):
+      if data is not None:
+        arrays['{:s}_param{:d}'.format(layer_name, i)] = data.astype(np.float32)
+  map_tensor_data(net, arrays)
+
+def malloc_net(net, specs, shared_net=None):
+  # malloc_net, reading parameters transformed by fold_params
+  #   if net.param_path is a packed parameter file, parameters are
+  #   mapped from the file by map_params instead
+  #   if shared_net is given, parameters (already transformed)
+  #   are shared with shared_net instead
+  import shutil
+  if shared_net:
+    share_params(net, shared_net)
+    pvalib.malloc_net(net)
+    return
+
+  if os.path.isfile(net.contents.param_path):
+    map_params(net, specs)
+    pvalib.malloc_net(net)
+    check_tensor_data(net)
+    return
+
+  folded = fold_params(net, specs)
+  try:
+    pvalib.malloc_net(net)
+  finally:
+    if folded is not None:
+      net.contents.param_path = folded[0]
+      shutil.rmtree(folded[1])
+
+def load_pva900(net=None, shared_net=None):
   proto_name = '../pvanet/9.0.0_mod1_tuned/9.0.0_mod1.new.21cls.pt'
-  proto = load_proto(proto_name)
-  parse_proto(proto, net=net)
+  if net is None:
+    parse_proto(load_proto(proto_name))
+  else:
+    specs = load_spec(proto_name)
+    build_net(net, specs)
   if net:
-    pvalib.malloc_net(net)
+    malloc_net(net, specs, shared_net)
 
-def load_pva33(net=None):
+def load_pva33(net=None, shared_net=None):
   proto_name = '9.0.0lite.pt'
-  proto = load_proto(proto_name)
-  parse_proto(proto, net=net)
+  if net is None:
+    parse_proto(load_proto(proto_name))
+  else:
+    specs = load_spec(proto_name)
+    build_net(net, specs)
   if net:
-    pvalib.get_tensor_by_name(net, 'conv1').contents.data_type = 1
-    pvalib.get_tensor_by_name(net, 'conv3').contents.data_type = 1
-    pvalib.malloc_net(net)
+    pvalib.get_tensor_by_name(net, 'conv1').contents.data_type = PRIVATE_DATA
+    pvalib.get_tensor_by_name(net, 'conv3').contents.data_type = PRIVATE_DATA
+    malloc_net(net, specs, shared_net)
+
+def clone_net(shared_net, load_net=load_pva900):
+  # new network instance sharing all parameters with shared_net
+  #   only activations and temporary space are newly allocated
+  #   shared_net must be freed after the clone
+  net = pvalib.create_empty_net()
+  net.contents.param_path = shared_net.contents.param_path
+  load_net(net=net, shared_net=shared_net)
+  return net
 
 def test():
   code_only = False
@@ -299,13 +804,14 @@ def test():
     net.contents.param_path = '../data/pvanet/pvanet'
     load_pva900(net=net)
     detect(net, '../dl/scripts/voc/000014.jpg')
-    print get_tensor_data(pvalib.get_tensor_by_name(net, 'out'))
-    pvalib.free_net(net)
+    print get_tensor_data(pvalib.get_tensor_by_name(net, 'out'))[0]
+    free_net(net)
   else:
     net = pvalib.create_empty_net()
     net.contents.param_path = '../data/pvanet/pvanet_light'
     load_pva33(net=net)
     detect(net, '../dl/scripts/voc/000014.jpg')
-    pvalib.free_net(net)
+    free_net(net)
 
-test()
+if __name__ == "__main__":
+  test()
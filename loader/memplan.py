@@ -0,0 +1,215 @@
+from loader import load_proto
+from cost import infer_cost, real_size
+
+# maximum number of shared memory blocks, MAX_NUM_SHARED_BLOCKS in core/net.h
+max_num_shared_blocks = 10
+
+# layer types that can overwrite their input (see add_chain_layer)
+in_place_types = ['ReLU', 'Scale', 'Power']
+
+def _count(shape):
+  count = 1
+  for dim in shape:
+    count *= dim
+  return count
+
+def _align(size, alignment):
+  return (size + alignment - 1) / alignment * alignment
+
+def private_names(records):
+  # outputs kept in private memory by the runtime
+  #   image info of image layer, and outputs of proposal & RoI pooling layers
+  #   (see init_image_layer, init_proposal_layer, init_roipool_layer)
+  names = []
+  for record in records:
+    if len(record['bottoms']) == 0:
+      names.extend(record['tops'][1:2])
+    elif record['type'] in ['Proposal', 'Python', 'ROIPooling']:
+      names.extend(record['tops'])
+  return names
+
+def block_layout(records, private=[]):
+  # shared memory blocks assigned by assign_shared_blocks in dl/src/core/net.cu
+  #   every block is as large as the largest shared tensor
+  #   return dict: num_blocks, block_bytes, shared_bytes, private_bytes,
+  #                unassigned (tensors not fitting in max_num_shared_blocks)
+  sizes = {}
+  alive_until = {}
+  last = len(records) - 1
+  for i, record in enumerate(records):
+    for name in record['bottoms']:
+      alive_until[name] = i
+    for name, shape in zip(record['tops'], record['shapes']):
+      sizes[name] = max(sizes.get(name, 0), _count(shape) * real_size)
+
+  is_assigned = {}
+  reserved_until = []
+  unassigned = []
+  for i, record in enumerate(records):
+    for name in record['tops']:
+      if name not in private and not is_assigned.has_key(name):
+        until = alive_until.get(name, last)
+        if until < i:
+          until = last
+        for blk_id in range(len(reserved_until)):
+          if reserved_until[blk_id] is None:
+            reserved_until[blk_id] = until
+            is_assigned[name] = blk_id
+            break
+        if not is_assigned.has_key(name):
+          if len(reserved_until) == max_num_shared_blocks:
+            unassigned.append(name)
+          else:
+            reserved_until.append(until)
+            is_assigned[name] = len(reserved_until) - 1
+      for blk_id in range(len(reserved_until)):
+        if reserved_until[blk_id] == i:
+          reserved_until[blk_id] = None
+
+  block_bytes = max([size for name, size in sizes.items() if name not in private] + [0])
+  return {
+    'num_blocks': len(reserved_until),
+    'block_bytes': block_bytes,
+    'shared_bytes': len(reserved_until) * block_bytes,
+    'private_bytes': sum([size for name, size in sizes.items() if name in private]),
+    'unassigned': unassigned,
+  }
+
+def live_ranges(records, private=[], in_place=True):
+  # activation buffers with their lifetimes
+  #   a buffer lives from the layer writing it to the last layer reading it,
+  #   and outputs never read live until the end
+  #   if in_place, ReLU, Scale, Power overwrite their input buffer
+  #   whenever the input is read by no later layer
+  #   return (list of buffers, list of layers made in-place)
+  #     buffer: dict of names (tensors in the buffer), size, start, end, private
+  last_read = {}
+  for i, record in enumerate(records):
+    for name in record['bottoms']:
+      last_read[name] = i
+
+  buffers = []
+  in_place_layers = []
+  current = {}
+  for i, record in enumerate(records):
+    for name in record['bottoms']:
+      if current.has_key(name):
+        current[name]['end'] = i
+    for name, shape, flag in zip(record['tops'], record['shapes'], record['in_place']):
+      if flag and current.has_key(name):
+        current[name]['end'] = i
+        continue
+      size = _count(shape) * real_size
+      if in_place and record['type'] in in_place_types and len(record['bottoms']) == 1:
+        bottom = record['bottoms'][0]
+        buf = current.get(bottom)
+        if buf is not None and not buf['private'] and name not in private \
+           and last_read.get(bottom) == i and buf['size'] == size:
+          buf['names'].append(name)
+          buf['end'] = i
+          current[name] = buf
+          in_place_layers.append(record['name'])
+          continue
+      buf = {'names': [name], 'size': size, 'start': i, 'end': i,
+             'private': name in private}
+      buffers.append(buf)
+      current[name] = buf
+
+  last = len(records) - 1
+  for buf in buffers:
+    if not any([last_read.has_key(name) for name in buf['names']]):
+      buf['end'] = last
+  return (buffers, in_place_layers)
+
+def plan_offsets(buffers, alignment=64):
+  # best-fit placement of shared buffers into a single arena
+  #   buffers are placed in descending order of size, each at the smallest
+  #   gap (among buffers alive at the same time) that it fits in
+  #   sets buf['offset'] for each shared buffer, and returns arena size
+  shared = [buf for buf in buffers if not buf['private']]
+  shared.sort(key=lambda buf: (-buf['size'], buf['start']))
+  placed = []
+  arena_size = 0
+  for buf in shared:
+    size = _align(buf['size'], alignment)
+    overlaps = [elem for elem in placed \
+                if elem['start'] <= buf['end'] and buf['start'] <= elem['end']]
+    overlaps.sort(key=lambda elem: elem['offset'])
+    best_offset, best_gap = None, None
+    prev_end = 0
+    for elem in overlaps:
+      gap = elem['offset'] - prev_end
+      if gap >= size and (best_gap is None or gap < best_gap):
+        best_offset, best_gap = prev_end, gap
+      prev_end = max(prev_end, elem['offset'] + _align(elem['size'], alignment))
+    buf['offset'] = best_offset if best_offset is not None else prev_end
+    placed.append(buf)
+    arena_size = max(arena_size, buf['offset'] + size)
+  return arena_size
+
+def peak_live_bytes(buffers):
+  # lower bound of any arena: maximum total size of shared buffers alive at once
+  shared = [buf for buf in buffers if not buf['private']]
+  if len(shared) == 0:
+    return 0
+  last = max([buf['end'] for buf in shared])
+  return max([sum([buf['size'] for buf in shared if buf['start'] <= i <= buf['end']]) \
+              for i in range(last + 1)])
+
+def plan_memory(proto, height=None, width=None, private=[], alignment=64):
+  # activation memory plan vs. current shared block layout
+  #   private: tensors set to PRIVATE_DATA by caller, e.g., conv1 & conv3
+  #            in load_pva33
+  #   return dict: layout (see block_layout), arena_bytes, peak_bytes,
+  #                private_bytes, in_place_layers, buffers
+  records = infer_cost(proto, height, width)
+  private = private_names(records) + [name for name in private]
+  layout = block_layout(records, private)
+  buffers, in_place_layers = live_ranges(records, private)
+  return {
+    'layout': layout,
+    'arena_bytes': plan_offsets(buffers, alignment),
+    'peak_bytes': peak_live_bytes(buffers),
+    'private_bytes': sum([buf['size'] for buf in buffers if buf['private']]),
+    'in_place_layers': in_place_layers,
+    'buffers': buffers,
+  }
+
+def show_plan(plan):
+  layout = plan['layout']
+  print 'Current: {:d} shared blocks x {:.2f}MB = {:.2f}MB, private {:.2f}MB'.format( \
+        layout['num_blocks'], layout['block_bytes'] / 1e6,
+        layout['shared_bytes'] / 1e6, layout['private_bytes'] / 1e6)
+  if len(layout['unassigned']) > 0:
+    print '  [ERROR] No shared block for {:s}'.format(', '.join(layout['unassigned']))
+  print 'Planned: arena {:.2f}MB (peak live {:.2f}MB), private {:.2f}MB'.format( \
+        plan['arena_bytes'] / 1e6, plan['peak_bytes'] / 1e6,
+        plan['private_bytes'] / 1e6)
+  print '  {:d} buffers, in-place: {:s}'.format( \
+        len(plan['buffers']), ', '.join(plan['in_place_layers']) or 'none')
+  current = layout['shared_bytes'] + layout['private_bytes']
+  planned = plan['arena_bytes'] + plan['private_bytes']
+  print 'Activation memory: {:.2f}MB -> {:.2f}MB ({:.1f}%)'.format( \
+        current / 1e6, planned / 1e6, 100.0 * planned / max(current, 1))
+
+def parse_args():
+  import sys, argparse
+  parser = argparse.ArgumentParser(description='Activation memory planner for prototxt')
+  parser.add_argument('proto_name',
+                      help='prototxt filename')
+  parser.add_argument('--private', dest='private',
+                      help='tensors set to PRIVATE_DATA (e.g., conv1 conv3 for PVA 3.3)',
+                      default=[], type=str, nargs='*')
+  parser.add_argument('--alignment', dest='alignment',
+                      help='alignment of buffer offsets in bytes',
+                      default=64, type=int)
+  if len(sys.argv) == 1:
+    parser.print_help()
+    sys.exit(1)
+  args = parser.parse_args()
+  return args
+
+if __name__ == "__main__":
+  args = parse_args()
+  show_plan(plan_memory(load_proto(args.proto_name), private=args.private,
+                        alignment=args.alignment))
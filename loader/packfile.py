@@ -0,0 +1,176 @@
+import struct
+import collections
+import numpy as np
+
+# packed parameter file
+#   header (64 bytes): magic, int32 version, int32 number of entries,
+#                      int64 offset of index, zero padding
+#   payloads: C-order arrays, each starting at a multiple of 64 bytes
+#   index: array of pack_entry_dtype, one for each payload
+#   index is written after payloads, so that arrays can be streamed
+#   to file without knowing them all in advance
+#   this module is the only reader & writer of the format,
+#   used by both dl.py and the loader
+pack_magic = 'PVAPACK\0'
+pack_version = 1
+pack_alignment = 64
+pack_header_size = 64
+pack_entry_dtype = np.dtype([('name', 'S64'), ('dtype', 'S8'),
+                             ('ndim', '<i4'), ('shape', '<i4', (8,)),
+                             ('reserved', '<i4'),
+                             ('offset', '<i8'), ('nbytes', '<i8')])
+
+def _read_header(header, filename):
+  # (number of entries, index offset) in a packed file header
+  if header[:len(pack_magic)] != pack_magic:
+    raise IOError('Not a packed parameter file: {:s}'.format(filename))
+  version, num_entries, index_offset = \
+      struct.unpack('<iiq', header[len(pack_magic):len(pack_magic) + 16])
+  if version != pack_version:
+    raise IOError('Unsupported pack version {:d}: {:s}'.format(version, filename))
+  return (num_entries, index_offset)
+
+class PackWriter(object):
+  # streaming writer of packed file, e.g., for dumping intermediate tensors
+  #   each array is written as soon as it is given, and the index at close()
+  #   append: add arrays to an existing file, after its index
+  #           the header is updated last, so the file stays valid
+  #           (with old entries only) until close() is done
+  #   if a name is written twice, load_pack returns the last array
+  def __init__(self, filename, append=False):
+    import os
+    self.entries = []
+    if append and os.path.exists(filename):
+      self.f = open(filename, 'r+b')
+      num_entries, index_offset = _read_header(self.f.read(pack_header_size), filename)
+      self.f.seek(index_offset)
+      self.entries = list(np.fromfile(self.f, dtype=pack_entry_dtype, count=num_entries))
+      self.f.seek(0, 2)
+    else:
+      self.f = open(filename, 'wb')
+      self.f.write('\0' * pack_header_size)
+
+  def write(self, name, data):
+    # return byte offset of data in the file
+    data = np.ascontiguousarray(data)
+    if len(name) > pack_entry_dtype['name'].itemsize:
+      raise ValueError('Too long name for packed file: {:s}'.format(name))
+    if data.ndim > pack_entry_dtype['shape'].shape[0]:
+      raise ValueError('Too many dimensions for packed file: {:s}'.format(name))
+    offset = self.f.tell()
+    padding = -offset % pack_alignment
+    self.f.write('\0' * padding)
+    entry = np.zeros((), dtype=pack_entry_dtype)
+    entry['name'] = name
+    entry['dtype'] = data.dtype.str
+    entry['ndim'] = data.ndim
+    entry['shape'][:data.ndim] = data.shape
+    entry['offset'] = offset + padding
+    entry['nbytes'] = data.nbytes
+    data.tofile(self.f)
+    self.entries.append(entry)
+    return offset + padding
+
+  def close(self):
+    index_offset = self.f.tell()
+    np.array(self.entries, dtype=pack_entry_dtype).tofile(self.f)
+    self.f.flush()
+    self.f.seek(0)
+    self.f.write(pack_magic)
+    self.f.write(struct.pack('<iiq', pack_version, len(self.entries), index_offset))
+    self.f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+def write_pack(filename, items, append=False):
+  # items: iterable of (name, array), e.g., list or generator
+  #   append: add items to an existing file (see PackWriter)
+  #   return dict: name -> byte offset of array in the file
+  offsets = {}
+  writer = PackWriter(filename, append=append)
+  for name, data in items:
+    offsets[name] = writer.write(name, data)
+  writer.close()
+  return offsets
+
+def load_pack(filename):
+  # return OrderedDict: name -> array
+  #   arrays are read-only views of a memory-mapped file,
+  #   so data is read from disk only when it is accessed
+  #   quantized arrays are returned as stored, together with their
+  #   scale tables (see dequantize)
+  #   only the index is read here, so any array can be accessed at random
+  #   without reading the others
+  buf = np.memmap(filename, dtype=np.uint8, mode='r')
+  num_entries, index_offset = _read_header(buf[:pack_header_size].tostring(), filename)
+  index_size = num_entries * pack_entry_dtype.itemsize
+  entries = buf[index_offset:index_offset + index_size].view(pack_entry_dtype)
+  arrays = collections.OrderedDict()
+  for entry in entries:
+    data = buf[entry['offset']:entry['offset'] + entry['nbytes']]
+    shape = tuple(entry['shape'][:entry['ndim']])
+    arrays[entry['name']] = data.view(np.dtype(entry['dtype'])).reshape(shape)
+  return arrays
+
+# quantized arrays in packed file
+#   int8: per-output-channel symmetric, W[o] ~ scale[o] * q[o], |q| <= 127,
+#         scale table is stored as "{name}_scale" in float32
+#   fp16: W ~ float16(W)
+#   only weights having >= quant_min_size elements are quantized
+#   (in PVANET, fc6 & fc7 taking most of the model), the others are stored
+#   as float32, since errors in early conv layers grow through the network
+quant_modes = ['int8', 'fp16']
+quant_min_size = 1 << 20
+quant_scale_suffix = '_scale'
+
+def quantize_int8(data, clip=1.0):
+  # clip: ratio of clipping threshold to max |W[o]|, scalar or per channel
+  #       (see quantize.py for calibration)
+  #   return (q: int8 array of data.shape, scale: float32 array)
+  W = data.reshape((data.shape[0], -1)).astype(np.float32)
+  threshold = np.abs(W).max(axis=1) * np.asarray(clip, dtype=np.float32)
+  scale = np.where(threshold > 0, threshold / 127, 1).astype(np.float32)
+  q = np.clip(np.round(W / scale.reshape((-1, 1))), -127, 127)
+  return (q.astype(np.int8).reshape(data.shape), scale)
+
+def quantize_items(items, mode='int8', min_size=quant_min_size, clips=None):
+  # (name, array) items of a packed file, with large weights quantized
+  #   clips: dict of name -> clip ratio for quantize_int8
+  if mode not in quant_modes:
+    raise ValueError('Unknown quantization mode: {:s}'.format(mode))
+  for name, data in items:
+    if data.ndim < 2 or data.size < min_size:
+      yield (name, data.astype(np.float32))
+    elif mode == 'fp16':
+      yield (name, data.astype(np.float16))
+    else:
+      clip = clips.get(name, 1.0) if clips is not None else 1.0
+      q, scale = quantize_int8(data, clip)
+      yield (name, q)
+      yield (name + quant_scale_suffix, scale)
+
+def dequantize(arrays):
+  # convert quantized arrays (see load_pack) to float32 in private memory,
+  # and drop their scale tables
+  #   since the runtime computes in float32 only, quantization reduces
+  #   file size and disk I/O, but not memory of loaded parameters
+  for name in [name for name in arrays.keys() if name.endswith(quant_scale_suffix)]:
+    q = arrays.get(name[:-len(quant_scale_suffix)])
+    if q is not None and q.dtype == np.int8:
+      scale = arrays.pop(name).reshape((-1, 1))
+      arrays[name[:-len(quant_scale_suffix)]] = \
+          (q.reshape((q.shape[0], -1)) * scale).reshape(q.shape)
+  for name, data in arrays.items():
+    if data.dtype == np.float16:
+      arrays[name] = data.astype(np.float32)
+  return arrays
+
+def read_pack(filename):
+  # arrays in a packed file as float32, e.g., parameters for the runtime
+  #   return dict: name -> read-only array in memory-mapped file,
+  #   or dequantized array
+  return dequantize(load_pack(filename))
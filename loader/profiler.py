@@ -0,0 +1,131 @@
+import json
+import numpy as np
+from pvanet import lib as pvalib
+from pvanet import detect
+
+# layer type -> group name used in reports
+layer_groups = {
+  'Convolution': 'conv',
+  'Deconvolution': 'deconv',
+  'InnerProduct': 'fc',
+  'Proposal': 'proposal',
+  'ROIPooling': 'roipool',
+}
+
+def get_layer_types(proto):
+  # map (converted) layer name -> layer type for a caffe_pb2.NetParameter
+  #   output layer "out" added by parse_proto is of type 'ODOut'
+  layer_types = {}
+  for layer in proto.layer:
+    layer_type = layer.type
+    if layer_type == 'Python' and layer.python_param.layer == 'ProposalLayer':
+      layer_type = 'Proposal'
+    layer_types[str(layer.name).replace('/', '_')] = layer_type
+  layer_types['out'] = 'ODOut'
+  return layer_types
+
+class LayerProfiler(object):
+  # per-layer average running time over a number of forward passes
+  #   Net.elapsed_times[i] holds a moving average (0.9 * old + 0.1 * new)
+  #   in microseconds, so the time of the latest run is recovered from
+  #   the values before and after each forward pass
+  def __init__(self, net, layer_types=None):
+    self.net = net
+    self.layer_types = layer_types if layer_types is not None else {}
+    self.num_layers = net.contents.num_layers
+    self.names = [net.contents.layers[i].name for i in range(self.num_layers)]
+    self.total_times = np.zeros((self.num_layers,), dtype=np.double)
+    self.num_runs = 0
+    self.prev_times = self._read()
+
+  def _read(self):
+    times = np.ctypeslib.as_array(self.net.contents.elapsed_times)
+    return times[:self.num_layers].astype(np.double, copy=True)
+
+  def update(self):
+    # call right after each forward pass
+    times = self._read()
+    last_times = np.where(self.prev_times == 0, times,
+                          (times - 0.9 * self.prev_times) / 0.1)
+    self.total_times += last_times
+    self.prev_times = times
+    self.num_runs += 1
+
+  def run(self, filenames, num_repeats=1):
+    for i in range(num_repeats):
+      for filename in filenames:
+        detect(self.net, filename)
+        self.update()
+
+  def report(self):
+    # list of per-layer records, in descending order of average time (ms)
+    records = []
+    mean_times = self.total_times / max(self.num_runs, 1) / 1000.0
+    total_time = max(mean_times.sum(), 1e-12)
+    for name, mean_time in zip(self.names, mean_times):
+      layer_type = self.layer_types.get(name, 'Unknown')
+      records.append({
+        'name': name,
+        'type': layer_type,
+        'group': layer_groups.get(layer_type, 'other'),
+        'time': mean_time,
+        'ratio': mean_time / total_time,
+      })
+    records.sort(key=lambda record: record['time'], reverse=True)
+    return records
+
+  def report_groups(self):
+    # dict: group name -> (total average time (ms), number of layers)
+    groups = {}
+    for record in self.report():
+      time, count = groups.get(record['group'], (0.0, 0))
+      groups[record['group']] = (time + record['time'], count + 1)
+    return groups
+
+  def show(self, num_top=20):
+    records = self.report()
+    total_time = sum([record['time'] for record in records])
+    print 'Average over {:d} runs: {:.3f}ms'.format(self.num_runs, total_time)
+    for record in records[:num_top]:
+      print '  {:32s} {:14s} {:10.3f}ms ({:5.1f}%)'.format( \
+            record['name'], record['type'], record['time'], 100 * record['ratio'])
+    for group, (time, count) in sorted(self.report_groups().items(), \
+                                       key=lambda item: -item[1][0]):
+      print '  [{:s}] {:d} layers, {:.3f}ms'.format(group, count, time)
+
+  def save_json(self, filename, model_name=None):
+    result = {
+      'model': model_name,
+      'num_runs': self.num_runs,
+      'layers': self.report(),
+      'groups': dict([(group, {'time': time, 'count': count}) \
+                      for group, (time, count) in self.report_groups().items()]),
+    }
+    f = open(filename, 'w')
+    json.dump(result, f, indent=2)
+    f.close()
+
+  def save_csv(self, filename):
+    f = open(filename, 'w')
+    f.write('name,type,group,time_ms,ratio\n')
+    for record in self.report():
+      f.write('{:s},{:s},{:s},{:f},{:f}\n'.format( \
+              record['name'], record['type'], record['group'],
+              record['time'], record['ratio']))
+    f.close()
+
+def compare_profiles(filename_a, filename_b):
+  # compare group-wise times of two profiles saved by save_json,
+  # e.g., PVA 9.0.0 vs. PVA 9.0.0lite
+  f = open(filename_a, 'r')
+  a = json.load(f)
+  f.close()
+  f = open(filename_b, 'r')
+  b = json.load(f)
+  f.close()
+
+  print '{:10s} {:>14s} {:>14s}'.format('group', a['model'] or filename_a, b['model'] or filename_b)
+  for group in sorted(set(a['groups'].keys()) | set(b['groups'].keys())):
+    time_a = a['groups'].get(group, {'time': 0})['time']
+    time_b = b['groups'].get(group, {'time': 0})['time']
+    print '{:10s} {:12.3f}ms {:12.3f}ms'.format(group, time_a, time_b)
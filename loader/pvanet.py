@@ -1,157 +1,635 @@
 import ctypes
-from scipy.ndimage import imread
+import threading
+import time
+import Queue
 import numpy as np
 
-lib = ctypes.CDLL('libdlcpu.so')
-
-lib._batch_size.restype = ctypes.c_int
-lib._max_ndim.restype = ctypes.c_int
-lib._max_name_len.restype = ctypes.c_int
-
-lib._max_num_bottoms.restype = ctypes.c_int
-lib._max_num_tops.restype = ctypes.c_int
-lib._max_num_params.restype = ctypes.c_int
-
-lib._max_num_tensors.restype = ctypes.c_int
-lib._max_num_layers.restype = ctypes.c_int
-lib._max_num_shared_blocks.restype = ctypes.c_int
-
-batch_size = lib._batch_size()
-max_ndim = lib._max_ndim()
-max_name_len = lib._max_name_len()
-
-max_num_bottoms = lib._max_num_bottoms()
-max_num_tops = lib._max_num_tops()
-max_num_params = lib._max_num_params()
-
-max_num_tensors = lib._max_num_tensors()
-max_num_layers = lib._max_num_layers()
-max_num_shared_blocks = lib._max_num_shared_blocks()
-
-class Tensor(ctypes.Structure):
-  _fields_ = [('name', ctypes.c_char * max_name_len),
-              ('num_items', ctypes.c_int),
-              ('ndim', ctypes.c_int),
-              ('shape', (ctypes.c_int * max_ndim) * batch_size),
-              ('start', ctypes.c_int * batch_size),
-              ('data', ctypes.POINTER(ctypes.c_float)),
-              ('data_type', ctypes.c_int)]
-
-class LayerOption(ctypes.Structure):
-  _fields_ = [('input_size', ctypes.c_int),
-              ('unit_size', ctypes.c_int),
-              ('max_image_size', ctypes.c_int),
-              ('bias', ctypes.c_int),
-              ('group', ctypes.c_int),
-              ('num_output', ctypes.c_int),
-              ('kernel_h', ctypes.c_int),
-              ('kernel_w', ctypes.c_int),
-              ('pad_h', ctypes.c_int),
-              ('pad_w', ctypes.c_int),
-              ('stride_h', ctypes.c_int),
-              ('stride_w', ctypes.c_int),
-              ('handle', ctypes.c_void_p),
-              ('pooled_height', ctypes.c_int),
-              ('pooled_width', ctypes.c_int),
-              ('spatial_scale', ctypes.c_float),
-              ('flatten_shape', ctypes.c_int),
-              ('negative_slope', ctypes.c_float),
-              ('anchor_scales', ctypes.POINTER(ctypes.c_float)),
-              ('anchor_ratios', ctypes.POINTER(ctypes.c_float)),
-              ('num_anchor_scales', ctypes.c_int),
-              ('num_anchor_ratios', ctypes.c_int),
-              ('base_size', ctypes.c_int),
-              ('feat_stride', ctypes.c_int),
-              ('min_size', ctypes.c_int),
-              ('pre_nms_topn', ctypes.c_int),
-              ('post_nms_topn', ctypes.c_int),
-              ('nms_thresh', ctypes.c_float),
-              ('score_thresh', ctypes.c_float),
-              ('bbox_vote', ctypes.c_int),
-              ('vote_thresh', ctypes.c_float),
-              ('scaled_dropout', ctypes.c_int),
-              ('test_dropout', ctypes.c_int),
-              ('dropout_ratio', ctypes.c_float),
-              ('power_weight', ctypes.c_float),
-              ('power_bias', ctypes.c_float),
-              ('power_order', ctypes.c_float),
-              ('num_bottoms', ctypes.c_int),
-              ('channel_axis', ctypes.c_int),
-              ('reshape', ctypes.c_int * max_ndim),
-              ('reshape_ndim', ctypes.c_int)]
-
-class Layer(ctypes.Structure):
-  _fields_ = [('name', ctypes.c_char * max_name_len),
-              ('p_bottoms', ctypes.POINTER(Tensor) * max_num_bottoms),
-              ('num_bottoms', ctypes.c_int),
-              ('p_tops', ctypes.POINTER(Tensor) * max_num_tops),
-              ('num_tops', ctypes.c_int),
-              ('p_params', ctypes.POINTER(Tensor) * max_num_params),
-              ('num_params', ctypes.c_int),
-              ('aux_data', ctypes.c_void_p),
-              ('f_forward', ctypes.c_void_p),
-              ('f_shape', ctypes.c_void_p),
-              ('f_init', ctypes.c_void_p),
-              ('f_free', ctypes.c_void_p),
-              ('option', LayerOption)]
-
-class Net(ctypes.Structure):
-  _fields_ = [('param_path', ctypes.c_char * 1024),
-              ('tensors', Tensor * max_num_tensors),
-              ('num_tensors', ctypes.c_int),
-              ('layers', Layer * max_num_layers),
-              ('num_layers', ctypes.c_int),
-              ('p_shared_blocks', ctypes.POINTER(ctypes.c_float) * max_num_shared_blocks),
-              ('num_shared_blocks', ctypes.c_int),
-              ('temp_cpu_data', ctypes.POINTER(ctypes.c_float)),
-              ('temp_data', ctypes.POINTER(ctypes.c_float)),
-              ('temp_space', ctypes.c_long),
-              ('const_data', ctypes.POINTER(ctypes.c_float)),
-              ('const_space', ctypes.c_long),
-              ('space_cpu', ctypes.c_long),
-              ('space', ctypes.c_long),
-              ('initialized', ctypes.c_int),
-              ('p_images', ctypes.c_char_p * batch_size),
-              ('image_heights', ctypes.c_int * batch_size),
-              ('image_widths', ctypes.c_int * batch_size),
-              ('num_images', ctypes.c_int),
-              ('elapsed_times', ctypes.c_double * max_num_layers),
-              ('blas_handle', ctypes.c_int)]
-
-lib.create_empty_net.restype = ctypes.POINTER(Net)
-
-lib.create_pvanet.restype = ctypes.POINTER(Net)
-
-lib.get_tensor_by_name.restype = ctypes.POINTER(Tensor)
-
-lib.get_layer_by_name.restype = ctypes.POINTER(Layer)
-
-lib.process_pvanet.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
-
-lib.add_power_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_float, ctypes.c_float, ctypes.c_float, ctypes.c_int]
-
-lib.add_relu_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_float]
-
-lib.add_proposal_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_float), ctypes.c_int, ctypes.POINTER(ctypes.c_float), ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_float, ctypes.c_int, ctypes.c_float]
-
-lib.add_roipool_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_float, ctypes.c_int]
-
-lib.add_dropout_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_float, ctypes.c_int, ctypes.c_int]
-
-lib.add_odout_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_float, ctypes.c_float, ctypes.c_int, ctypes.c_float]
-
-def detect(net, filename):
-  img = imread(filename)
-  if img is not None:
-    lib.process_pvanet(net, img[:,:,::-1].tobytes(), img.shape[0], img.shape[1], None, None, None)
+# Tensor.data_type values
+SHARED_DATA = 0
+PRIVATE_DATA = 1
+PARAM_DATA = 2
+SHARED_PARAM_DATA = 3
+
+# constants and data structures defined by libdlcpu.so
+#   library is loaded at first use of lib, see _load
+batch_size = None
+max_ndim = None
+max_name_len = None
+max_num_bottoms = None
+max_num_tops = None
+max_num_params = None
+max_num_tensors = None
+max_num_layers = None
+max_num_shared_blocks = None
+Tensor = None
+LayerOption = None
+Layer = None
+Net = None
+
+def _load():
+  global batch_size, max_ndim, max_name_len
+  global max_num_bottoms, max_num_tops, max_num_params
+  global max_num_tensors, max_num_layers, max_num_shared_blocks
+  global Tensor, LayerOption, Layer, Net
+
+  lib = ctypes.CDLL('libdlcpu.so')
+
+  lib._batch_size.restype = ctypes.c_int
+  lib._max_ndim.restype = ctypes.c_int
+  lib._max_name_len.restype = ctypes.c_int
+
+  lib._max_num_bottoms.restype = ctypes.c_int
+  lib._max_num_tops.restype = ctypes.c_int
+  lib._max_num_params.restype = ctypes.c_int
+
+  lib._max_num_tensors.restype = ctypes.c_int
+  lib._max_num_layers.restype = ctypes.c_int
+  lib._max_num_shared_blocks.restype = ctypes.c_int
+
+  batch_size = lib._batch_size()
+  max_ndim = lib._max_ndim()
+  max_name_len = lib._max_name_len()
+
+  max_num_bottoms = lib._max_num_bottoms()
+  max_num_tops = lib._max_num_tops()
+  max_num_params = lib._max_num_params()
+
+  max_num_tensors = lib._max_num_tensors()
+  max_num_layers = lib._max_num_layers()
+  max_num_shared_blocks = lib._max_num_shared_blocks()
+
+  class Tensor(ctypes.Structure):
+    _fields_ = [('name', ctypes.c_char * max_name_len),
+                ('num_items', ctypes.c_int),
+                ('ndim', ctypes.c_int),
+                ('shape', (ctypes.c_int * max_ndim) * batch_size),
+                ('start', ctypes.c_int * batch_size),
+                ('data', ctypes.POINTER(ctypes.c_float)),
+                ('data_type', ctypes.c_int)]
+
+  class LayerOption(ctypes.Structure):
+    _fields_ = [('input_size', ctypes.c_int),
+                ('unit_size', ctypes.c_int),
+                ('max_image_size', ctypes.c_int),
+                ('bias', ctypes.c_int),
+                ('group', ctypes.c_int),
+                ('num_output', ctypes.c_int),
+                ('kernel_h', ctypes.c_int),
+                ('kernel_w', ctypes.c_int),
+                ('pad_h', ctypes.c_int),
+                ('pad_w', ctypes.c_int),
+                ('stride_h', ctypes.c_int),
+                ('stride_w', ctypes.c_int),
+                ('handle', ctypes.c_void_p),
+                ('pooled_height', ctypes.c_int),
+                ('pooled_width', ctypes.c_int),
+                ('spatial_scale', ctypes.c_float),
+                ('flatten_shape', ctypes.c_int),
+                ('negative_slope', ctypes.c_float),
+                ('fused_relu', ctypes.c_int),
+                ('anchor_scales', ctypes.POINTER(ctypes.c_float)),
+                ('anchor_ratios', ctypes.POINTER(ctypes.c_float)),
+                ('num_anchor_scales', ctypes.c_int),
+                ('num_anchor_ratios', ctypes.c_int),
+                ('base_size', ctypes.c_int),
+                ('feat_stride', ctypes.c_int),
+                ('min_size', ctypes.c_int),
+                ('pre_nms_topn', ctypes.c_int),
+                ('post_nms_topn', ctypes.c_int),
+                ('nms_thresh', ctypes.c_float),
+                ('score_thresh', ctypes.c_float),
+                ('bbox_vote', ctypes.c_int),
+                ('vote_thresh', ctypes.c_float),
+                ('scaled_dropout', ctypes.c_int),
+                ('test_dropout', ctypes.c_int),
+                ('dropout_ratio', ctypes.c_float),
+                ('power_weight', ctypes.c_float),
+                ('power_bias', ctypes.c_float),
+                ('power_order', ctypes.c_float),
+                ('channel_axis', ctypes.c_int),
+                ('reshape', ctypes.c_int * max_ndim),
+                ('reshape_ndim', ctypes.c_int)]
+
+  class Layer(ctypes.Structure):
+    _fields_ = [('name', ctypes.c_char * max_name_len),
+                ('p_bottoms', ctypes.POINTER(Tensor) * max_num_bottoms),
+                ('num_bottoms', ctypes.c_int),
+                ('p_tops', ctypes.POINTER(Tensor) * max_num_tops),
+                ('num_tops', ctypes.c_int),
+                ('p_params', ctypes.POINTER(Tensor) * max_num_params),
+                ('num_params', ctypes.c_int),
+                ('aux_data', ctypes.c_void_p),
+                ('f_forward', ctypes.c_void_p),
+                ('f_shape', ctypes.c_void_p),
+                ('f_init', ctypes.c_void_p),
+                ('f_free', ctypes.c_void_p),
+                ('option', LayerOption)]
+
+  class Net(ctypes.Structure):
+    _fields_ = [('param_path', ctypes.c_char * 1024),
+                ('tensors', Tensor * max_num_tensors),
+                ('num_tensors', ctypes.c_int),
+                ('layers', Layer * max_num_layers),
+                ('num_layers', ctypes.c_int),
+                ('p_shared_blocks', ctypes.POINTER(ctypes.c_float) * max_num_shared_blocks),
+                ('num_shared_blocks', ctypes.c_int),
+                ('temp_cpu_data', ctypes.POINTER(ctypes.c_float)),
+                ('temp_data', ctypes.POINTER(ctypes.c_float)),
+                ('temp_space', ctypes.c_long),
+                ('const_data', ctypes.POINTER(ctypes.c_float)),
+                ('const_space', ctypes.c_long),
+                ('space_cpu', ctypes.c_long),
+                ('space', ctypes.c_long),
+                ('initialized', ctypes.c_int),
+                ('p_images', ctypes.c_char_p * batch_size),
+                ('image_heights', ctypes.c_int * batch_size),
+                ('image_widths', ctypes.c_int * batch_size),
+                ('num_images', ctypes.c_int),
+                ('elapsed_times', ctypes.c_double * max_num_layers),
+                ('blas_handle', ctypes.c_int)]
+
+  lib.create_empty_net.restype = ctypes.POINTER(Net)
+
+  lib.create_pvanet.restype = ctypes.POINTER(Net)
+
+  lib.get_tensor_by_name.restype = ctypes.POINTER(Tensor)
+
+  lib.get_layer_by_name.restype = ctypes.POINTER(Layer)
+
+  lib.process_pvanet.argtypes = [ctypes.POINTER(Net), ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+
+  lib.process_batch_pvanet.argtypes = [ctypes.POINTER(Net), ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+
+  lib.add_power_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_float, ctypes.c_float, ctypes.c_float, ctypes.c_int]
+
+  lib.add_relu_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_float]
+
+  lib.compute_scaled_size.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_float), ctypes.POINTER(ctypes.c_float), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+
+  lib.fuse_relu_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_float]
+
+  lib.add_proposal_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_float), ctypes.c_int, ctypes.POINTER(ctypes.c_float), ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_float, ctypes.c_int, ctypes.c_float]
+
+  lib.add_roipool_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_float, ctypes.c_int]
+
+  lib.add_dropout_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_float, ctypes.c_int, ctypes.c_int]
+
+  lib.add_odout_layer.argtypes = [ctypes.POINTER(Net), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_float, ctypes.c_float, ctypes.c_int, ctypes.c_float]
+
+  return lib
+
+class _Library(object):
+  # proxy to libdlcpu.so
+  #   library is loaded when any of its functions is accessed first
+  def __init__(self):
+    self._lib = None
+    self._lock = threading.Lock()
+
+  def __getattr__(self, name):
+    if self._lib is None:
+      with self._lock:
+        if self._lib is None:
+          self._lib = _load()
+    return getattr(self._lib, name)
+
+lib = _Library()
+
+# reusable BGR image buffers
+#   key: (address of Net structure, batch item index)
+_image_buffers = {}
+
+def _get_image_buffer(key, height, width):
+  size = height * width * 3
+  buf = _image_buffers.get(key)
+  if buf is None or buf.size < size:
+    buf = np.empty((size,), dtype=np.uint8)
+    if key is not None:
+      _image_buffers[key] = buf
+  return buf[:size].reshape((height, width, 3))
+
+def _is_filename(image):
+  # str: filename, unless it has NUL bytes that no path can contain
+  #      (encoded images always have them in their headers)
+  # bytearray, memoryview, buffer: encoded image
+  return isinstance(image, str) and '\0' not in image
+
+def _decode(image):
+  # decode a filename or encoded image bytes
+  #   return (image array or None, whether the array is in BGR order)
+  #   OpenCV decodes directly to BGR if available, otherwise PIL is used
+  #   encoded bytes are viewed as uint8 array without copy, except for
+  #   memoryview, which np.frombuffer does not accept in Python 2
+  data = None
+  if not _is_filename(image):
+    if isinstance(image, memoryview):
+      image = image.tobytes()
+    data = np.frombuffer(image, dtype=np.uint8)
 
-def get_tensor_data(tensor):
   try:
-    tensor = tensor.contents
-    shape = np.ctypeslib.as_array(tensor.shape)[0, :tensor.ndim]
-    size = np.prod(shape)
-    p_data = ctypes.addressof(tensor.data.contents)
-    data = np.ctypeslib.as_array((ctypes.c_float * size).from_address(p_data)).reshape(shape)
-    return data
-  except Exception:
+    import cv2
+    if data is None:
+      img = cv2.imread(image, cv2.IMREAD_COLOR)
+    else:
+      img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    return (img, True)
+  except ImportError:
+    pass
+
+  # None for an unreadable image, same as OpenCV
+  try:
+    if data is None:
+      from scipy.ndimage import imread
+      return (imread(image), False)
+    from PIL import Image
+    from io import BytesIO
+    return (np.asarray(Image.open(BytesIO(data.tostring())).convert('RGB')), False)
+  except IOError:
+    return (None, False)
+
+def decode_image(image, key=None, bgr=False):
+  # convert an input image to C-contiguous uint8 BGR array (height x width x 3)
+  #   image: filename (str), encoded image (bytearray, memoryview, buffer,
+  #          or str read from an image file), or uint8 image array
+  #          (height x width x 3 or height x width)
+  #   bgr: whether a given image array is already in BGR order
+  #        (arrays are in RGB order by default, same as imread)
+  #   key: if given, RGB -> BGR conversion writes into a buffer reused
+  #        across calls with the same key
+  #   a BGR array given as input is used as is, without copy
+  if isinstance(image, (str, bytearray, memoryview, buffer)):
+    img, bgr = _decode(image)
+  else:
+    img = image
+  if img is None:
     return None
+  if img.dtype != np.uint8:
+    raise ValueError('Image array must be uint8, not {:s}'.format(str(img.dtype)))
+
+  if img.ndim == 3 and img.shape[2] == 3 and bgr \
+      and img.dtype == np.uint8 and img.flags['C_CONTIGUOUS']:
+    return img
+
+  buf = _get_image_buffer(key, img.shape[0], img.shape[1])
+  if img.ndim == 2:
+    buf[...] = img[:, :, None]
+  elif bgr:
+    buf[...] = img[:, :, :3]
+  else:
+    buf[...] = img[:, :, 2::-1]
+  return buf
+
+def scaled_size(raw_h, raw_w, input_size, unit_size):
+  # size of resized input for a raw image, without loading the library
+  #   same as compute_scaled_size in dl/src/layers/image.cu,
+  #   step by step in float32, so that results are identical
+  #   (see resized_size for the one computed by the library)
+  f = np.float32
+  long_side_cap = f(input_size * 10 // 6)
+  short_side_cap = f(input_size)
+  short_side = f(min(raw_h, raw_w))
+  long_side = f(max(raw_h, raw_w))
+  scale = short_side_cap / short_side
+  if int(scale * long_side + f(0.5)) > long_side_cap:
+    scale = long_side_cap / long_side
+  scale_h = f(int(f(raw_h) * scale / f(unit_size)) * unit_size) / f(raw_h)
+  scale_w = f(int(f(raw_w) * scale / f(unit_size)) * unit_size) / f(raw_w)
+  return (int(f(raw_h) * scale_h + f(0.5)), int(f(raw_w) * scale_w + f(0.5)))
+
+def resized_size(raw_h, raw_w, input_size, unit_size):
+  # size of resized input for a raw image, computed by compute_scaled_size
+  scale_h = ctypes.c_float()
+  scale_w = ctypes.c_float()
+  resized_h = ctypes.c_int()
+  resized_w = ctypes.c_int()
+  lib.compute_scaled_size(raw_h, raw_w, input_size, unit_size,
+                          ctypes.byref(scale_h), ctypes.byref(scale_w),
+                          ctypes.byref(resized_h), ctypes.byref(resized_w))
+  return (resized_h.value, resized_w.value)
+
+def detect(net, image, bgr=False):
+  # image: filename, encoded image bytes, or image array (see decode_image)
+  img = decode_image(image, key=(ctypes.addressof(net.contents), 0), bgr=bgr)
+  if img is not None:
+    lib.process_pvanet(net, img.ctypes.data, img.shape[0], img.shape[1], None, None, None)
+
+def detect_batch(net, images, bgr=False):
+  # images: list of filenames, encoded images or image arrays
+  #         (see decode_image)
+  # returns a list of per-image 'out' arrays, one for each given image
+  #   None for an image that cannot be decoded, which is left out of
+  #   the forward pass
+  #   images are fed to the network in chunks of batch_size
+  p_net = ctypes.addressof(net.contents)
+  results = []
+  for begin in range(0, len(images), batch_size):
+    imgs = [decode_image(image, key=(p_net, n), bgr=bgr)
+            for n, image in enumerate(images[begin:begin + batch_size])]
+    for n, img in enumerate(imgs):
+      if img is None:
+        print '[ERROR] Failed to decode image {:d} in batch'.format(begin + n)
+    decoded = [n for n, img in enumerate(imgs) if img is not None]
+    chunk = [None] * len(imgs)
+    imgs = [imgs[n] for n in decoded]
+    num_images = len(imgs)
+    if num_images == 0:
+      results.extend(chunk)
+      continue
+
+    # imgs keeps references to BGR image buffers until forward pass is done
+    p_images = (ctypes.c_void_p * num_images)(*[img.ctypes.data for img in imgs])
+    heights = (ctypes.c_int * num_images)(*[img.shape[0] for img in imgs])
+    widths = (ctypes.c_int * num_images)(*[img.shape[1] for img in imgs])
+    lib.process_batch_pvanet(net, p_images, heights, widths, num_images, None, None, None)
+
+    # split output boxes along batch items
+    #   output memory is reused by next forward pass, so copy each item
+    out = get_tensor_data(lib.get_tensor_by_name(net, 'out'))
+    for n, data in zip(decoded, out):
+      chunk[n] = data.copy()
+    results.extend(chunk)
+  return results
+
+class DetectionTimeout(RuntimeError):
+  # raised by DetectionRequest.wait when detection is not done in time,
+  # as Queue.get raises Queue.Empty
+  pass
+
+class DetectionRequest(object):
+  # handle for an image submitted to DetectorPool
+  #   wait() blocks until detection is done and returns 'out' array
+  #   (None for an image that cannot be decoded)
+  #   wait(timeout) raises DetectionTimeout if not done within timeout
+  #   seconds; the request stays valid, so wait() can be called again
+  def __init__(self, image):
+    self.image = image
+    self.result = None
+    self.error = None
+    self.submit_time = time.time()
+    self.done = threading.Event()
+
+  def wait(self, timeout=None):
+    if not self.done.wait(timeout):
+      raise DetectionTimeout('Detection not done in {:g} seconds'.format(timeout))
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+class DetectorPool(object):
+  # num_workers independent networks, each served by its own thread
+  #   load_net: network builder such as loader.load_pva900(net=...)
+  #   share_params: if True, workers other than the first one share
+  #                 parameters of the first worker's network
+  #                 load_net must accept shared_net=... in this case
+  #   ctypes releases GIL while process_pvanet runs,
+  #   so workers run forward passes concurrently on multiple cores
+  def __init__(self, num_workers, param_path, load_net, share_params=False,
+               max_latencies=10000):
+    self.nets = []
+    for i in range(num_workers):
+      net = lib.create_empty_net()
+      net.contents.param_path = param_path
+      if share_params and i > 0:
+        load_net(net=net, shared_net=self.nets[0])
+      else:
+        load_net(net=net)
+      self.nets.append(net)
+
+    self.requests = Queue.Queue()
+    self.lock = threading.Lock()
+    self.busy_times = [0.0] * num_workers
+    self.num_processed = [0] * num_workers
+    self.latencies = []
+    self.max_latencies = max_latencies
+    self.start_time = time.time()
+
+    self.workers = []
+    for i in range(num_workers):
+      worker = threading.Thread(target=self._run, args=(i,))
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+  def _run(self, worker_id):
+    net = self.nets[worker_id]
+    while True:
+      request = self.requests.get()
+      if request is None:
+        break
+      start_time = time.time()
+      try:
+        request.result = detect_batch(net, [request.image])[0]
+      except Exception as e:
+        request.error = e
+      end_time = time.time()
+
+      with self.lock:
+        self.busy_times[worker_id] += end_time - start_time
+        self.num_processed[worker_id] += 1
+        self.latencies.append(end_time - request.submit_time)
+        if len(self.latencies) > self.max_latencies:
+          del self.latencies[:len(self.latencies) - self.max_latencies]
+      request.done.set()
+
+  def submit(self, image):
+    request = DetectionRequest(image)
+    self.requests.put(request)
+    return request
+
+  def detect(self, image):
+    return self.submit(image).wait()
+
+  def map(self, images):
+    requests = [self.submit(image) for image in images]
+    return [request.wait() for request in requests]
+
+  def stats(self):
+    # queue_depth: number of requests waiting for a free worker
+    # utilization: fraction of wall-clock time each worker was busy
+    # p50, p99: request latency (queueing + detection) in seconds
+    with self.lock:
+      elapsed_time = max(time.time() - self.start_time, 1e-6)
+      latencies = np.array(self.latencies, dtype=np.double)
+      stats = {
+        'queue_depth': self.requests.qsize(),
+        'num_processed': list(self.num_processed),
+        'utilization': [busy / elapsed_time for busy in self.busy_times],
+      }
+    if len(latencies) > 0:
+      stats['p50'] = np.percentile(latencies, 50)
+      stats['p99'] = np.percentile(latencies, 99)
+    else:
+      stats['p50'] = stats['p99'] = None
+    return stats
+
+  def close(self):
+    for worker in self.workers:
+      self.requests.put(None)
+    for worker in self.workers:
+      worker.join()
+    # free clones first, since they may refer to the first net's parameters
+    for net in self.nets[::-1]:
+      free_net(net)
+    self.nets = []
+
+def share_params(net, shared_net):
+  # let parameter tensors of net refer to those of shared_net
+  #   must be called after all layers are added and before malloc_net
+  #   shared_net must be initialized, and must be freed after net
+  src = shared_net.contents
+  src_params = {}
+  for i in range(src.num_tensors):
+    if src.tensors[i].data_type == PARAM_DATA:
+      src_params[src.tensors[i].name] = src.tensors[i]
+
+  dest = net.contents
+  for i in range(dest.num_tensors):
+    tensor = dest.tensors[i]
+    if tensor.data_type == PARAM_DATA and src_params.has_key(tensor.name):
+      tensor.data = src_params[tensor.name].data
+      tensor.data_type = SHARED_PARAM_DATA
+
+# arrays referred by networks' parameter tensors, see map_tensor_data
+#   net address -> dict: tensor name -> array
+_mapped_arrays = {}
+
+def map_tensor_data(net, arrays):
+  # let parameter tensors of net refer to float32 arrays without copying
+  #   arrays: dict: tensor name -> array, e.g., memory-mapped file
+  #   must be called after all layers are added and before malloc_net
+  #   arrays are kept alive until unmap_tensor_data is called
+  mapped = {}
+  dest = net.contents
+  for i in range(dest.num_tensors):
+    tensor = dest.tensors[i]
+    if tensor.data_type == PARAM_DATA and arrays.has_key(tensor.name):
+      data = arrays[tensor.name]
+      if data.dtype != np.float32 or not data.flags.c_contiguous:
+        print '[ERROR] Tensor {:s}: Not a contiguous float32 array'.format(tensor.name)
+        continue
+      tensor.data = data.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+      tensor.data_type = SHARED_PARAM_DATA
+      mapped[tensor.name] = data
+  _mapped_arrays[ctypes.addressof(dest)] = mapped
+
+def check_tensor_data(net):
+  # compare sizes of tensors & arrays given by map_tensor_data
+  #   must be called after malloc_net
+  mapped = _mapped_arrays.get(ctypes.addressof(net.contents), {})
+  dest = net.contents
+  for i in range(dest.num_tensors):
+    tensor = dest.tensors[i]
+    if mapped.has_key(tensor.name):
+      size = sum([int(np.prod(tensor.shape[n][:tensor.ndim])) for n in range(tensor.num_items)])
+      if size != mapped[tensor.name].size:
+        print '[ERROR] Size mismatch: {:s} ({:d}) != tensor ({:d})'.format( \
+              tensor.name, mapped[tensor.name].size, size)
+
+def unmap_tensor_data(net):
+  # release arrays given by map_tensor_data
+  #   must be called after free_net
+  _mapped_arrays.pop(ctypes.addressof(net.contents), None)
+
+def free_net(net):
+  # free_net, together with arrays kept for net in this module
+  #   (arrays given by map_tensor_data, image buffers, tensor views)
+  #   use this instead of lib.free_net, so that nets created repeatedly
+  #   (e.g., DetectorPool workers) do not leak these arrays
+  address = ctypes.addressof(net.contents)
+  end = address + ctypes.sizeof(net.contents)
+  lib.free_net(net)
+  unmap_tensor_data(net)
+  for key in [key for key in _image_buffers.keys() if key[0] == address]:
+    del _image_buffers[key]
+  for key in [key for key in _tensor_views.keys() if address <= key < end]:
+    del _tensor_views[key]
+
+# structured output box: predicted class, (x1, y1, x2, y2), score
+box_dtype = np.dtype([('cls', np.int32),
+                      ('x1', np.float32), ('y1', np.float32),
+                      ('x2', np.float32), ('y2', np.float32),
+                      ('score', np.float32)])
+
+def decode_output(out, im_info=None, score_thresh=None, topk=None,
+                  input_coords=False):
+  # convert raw 'out' array (num_boxes x 6) to structured array of box_dtype
+  #   out: a batch item of 'out' tensor,  (class, x1, y1, x2, y2, score)
+  #        boxes are given at original image coordinates
+  #   im_info: a batch item of 'im_info' tensor,
+  #            (resized h, resized w, scale_h, scale_w, raw h, raw w)
+  #            if given, boxes are clipped to the original image region
+  #   score_thresh: discard boxes whose scores < score_thresh
+  #   topk: keep top-k scored boxes per class
+  #   input_coords: if True, boxes are rescaled to network input
+  #                 coordinates using im_info
+  #   output boxes are sorted by (class, descending score)
+  out = np.asarray(out, dtype=np.float32).reshape((-1, 6))
+  if score_thresh is not None:
+    out = out[out[:, 5] >= score_thresh]
+
+  # sort by class, and then by score in descending order
+  order = np.lexsort((-out[:, 5], out[:, 0]))
+  out = out[order]
+
+  # rank of each box within its class
+  if topk is not None and len(out) > 0:
+    cls = out[:, 0].astype(np.int32)
+    first = np.searchsorted(cls, cls, side='left')
+    out = out[np.arange(len(cls)) - first < topk]
+
+  boxes = np.empty((len(out),), dtype=box_dtype)
+  boxes['cls'] = out[:, 0]
+  boxes['score'] = out[:, 5]
+  coords = out[:, 1:5]
+  if im_info is not None:
+    raw_h, raw_w = im_info[4], im_info[5]
+    coords = np.clip(coords, 0, [raw_w - 1, raw_h - 1, raw_w - 1, raw_h - 1])
+    if input_coords:
+      coords = coords * np.array([im_info[3], im_info[2], im_info[3], im_info[2]],
+                                 dtype=np.float32)
+  boxes['x1'] = coords[:, 0]
+  boxes['y1'] = coords[:, 1]
+  boxes['x2'] = coords[:, 2]
+  boxes['y2'] = coords[:, 3]
+  return boxes
+
+def get_detections(net, score_thresh=None, topk=None, input_coords=False):
+  # structured output boxes (see decode_output) for each batch item
+  outs = get_tensor_data(lib.get_tensor_by_name(net, 'out'))
+  im_infos = get_tensor_data(lib.get_tensor_by_name(net, 'im_info'))
+  return [decode_output(out, im_info, score_thresh, topk, input_coords) \
+          for out, im_info in zip(outs, im_infos)]
+
+# cache of per-item views for each tensor
+#   key: address of Tensor structure
+#   value: (layout of tensor, list of views)
+_tensor_views = {}
+
+def get_tensor_data(tensor):
+  # list of zero-copy arrays, one for each batch item in tensor
+  #   n-th array refers to memory at tensor.start[n] with shape tensor.shape[n]
+  #   arrays are valid until the network is freed or reshaped,
+  #   and are overwritten by the next forward pass
+  #   raise ValueError if tensor has no data (e.g., before malloc_net)
+  p_tensor = ctypes.addressof(tensor.contents)
+  tensor = tensor.contents
+  p_data = ctypes.cast(tensor.data, ctypes.c_void_p).value
+  if not p_data:
+    raise ValueError('Tensor {:s}: No data allocated'.format(tensor.name))
+  ndim = tensor.ndim
+  num_items = tensor.num_items
+  shapes = tuple([tuple(tensor.shape[n][:ndim]) for n in range(num_items)])
+  starts = tuple(tensor.start[:num_items])
+  layout = (p_data, shapes, starts)
+
+  # a new list for each call, so that callers cannot modify the cache
+  cached = _tensor_views.get(p_tensor)
+  if cached is not None and cached[0] == layout:
+    return list(cached[1])
+
+  sizes = [int(np.prod(shape)) for shape in shapes]
+  total_size = max([start + size for start, size in zip(starts, sizes)] + [0])
+  flat = np.ctypeslib.as_array(tensor.data, shape=(max(total_size, 1),))
+  views = tuple([flat[start:start + size].reshape(shape) \
+                 for start, size, shape in zip(starts, sizes, shapes)])
+  _tensor_views[p_tensor] = (layout, views)
+  return list(views)
@@ -0,0 +1,137 @@
+import os
+import numpy as np
+from pvanet import lib as pvalib
+from pvanet import detect, get_tensor_data, free_net, PRIVATE_DATA
+from loader import load_spec, build_net, malloc_net
+from loader import _read_bin
+from packfile import read_pack, write_pack
+from packfile import quant_modes, quant_min_size, quantize_int8, quantize_items
+
+# quantized parameter file, see packfile.quantize_items
+#   only weights having >= min_size elements are quantized,
+#   by default fc6 & fc7 in PVANET
+
+# candidate ratios of int8 clipping threshold to max |W[o]|
+clip_ratios = [1.0, 0.9, 0.8, 0.7, 0.6, 0.5]
+
+def read_params(param_path):
+  # list of (name, float32 array) in a packed file or a directory of .bin files
+  if os.path.isfile(param_path):
+    arrays = read_pack(param_path)
+    return [(name, arrays[name]) for name in sorted(arrays.keys())]
+  return [(name[:-4], _read_bin(os.path.join(param_path, name))) \
+          for name in sorted(os.listdir(param_path)) if name.endswith('.bin')]
+
+def collect_inputs(net, specs, images, max_rows=512):
+  # inputs of fc layers over sample images
+  #   net must be built by build_net(net, specs) but not allocated yet
+  #   input tensors are set to PRIVATE_DATA so that later layers do not
+  #   overwrite them, and up to max_rows rows (e.g., RoIs) are sampled
+  #   return dict: layer name -> input matrix (rows x input dim)
+  bottoms = dict([(args[0], args[1]) for func_name, args in specs \
+                  if func_name == 'add_fc_layer'])
+  for bottom in set(bottoms.values()):
+    pvalib.get_tensor_by_name(net, bottom).contents.data_type = PRIVATE_DATA
+  malloc_net(net, specs)
+
+  rng = np.random.RandomState(0)
+  rows_per_image = max(1, max_rows / max(len(images), 1))
+  inputs = dict([(layer_name, []) for layer_name in bottoms.keys()])
+  for image in images:
+    detect(net, image)
+    for layer_name, bottom in bottoms.items():
+      data = get_tensor_data(pvalib.get_tensor_by_name(net, bottom))[0]
+      data = data.reshape((data.shape[0], -1))
+      rows = rng.permutation(data.shape[0])[:rows_per_image]
+      inputs[layer_name].append(data[np.sort(rows)].copy())
+  return dict([(layer_name, np.concatenate(rows)) \
+               for layer_name, rows in inputs.items() if len(rows) > 0])
+
+def output_error(X, W, q, scale):
+  # squared error of fc outputs X * W' for each output channel o,
+  # when W[o] is replaced by scale[o] * q[o]
+  D = W - q.reshape(W.shape) * scale.reshape((-1, 1))
+  return (np.dot(X, D.T) ** 2).sum(axis=0)
+
+def calibrate(inputs, params, min_size=quant_min_size, ratios=clip_ratios):
+  # int8 clipping ratio of each output channel of fc layers,
+  # minimizing squared error of layer outputs for sample inputs
+  #   clipping a few outliers makes the step size of all other weights
+  #   smaller, which is often better than covering max |W[o]| (ratio 1)
+  #   inputs: see collect_inputs, params: see read_params
+  #   return (clips, report)
+  #     clips: dict of weight name -> per-channel clip ratios
+  #     report: list of (weight name, relative output error with ratio 1,
+  #                      relative output error with calibrated ratios)
+  params = dict(params)
+  clips = {}
+  report = []
+  for layer_name, X in sorted(inputs.items()):
+    name = '{:s}_param0'.format(layer_name)
+    if not params.has_key(name) or params[name].size < min_size:
+      continue
+    W = params[name].reshape((params[name].shape[0], -1)).astype(np.float32)
+    X = X.astype(np.float32)
+    errors = np.array([output_error(X, W, *quantize_int8(W, ratio)) for ratio in ratios])
+    best = errors.argmin(axis=0)
+    clips[name] = np.array(ratios, dtype=np.float32)[best]
+    norm = max((np.dot(X, W.T) ** 2).sum(), np.finfo(np.float32).tiny)
+    report.append((name, np.sqrt(errors[0].sum() / norm),
+                   np.sqrt(errors.min(axis=0).sum() / norm)))
+  return (clips, report)
+
+def quantize_params(params, filename, mode='int8', min_size=quant_min_size, clips=None):
+  # write params (see read_params) to a packed file with large weights quantized
+  #   clips: see calibrate, max |W[o]| is used for weights not in clips
+  #   return (original bytes, quantized bytes)
+  write_pack(filename, quantize_items(params, mode, min_size, clips))
+  return (sum([data.size * 4 for name, data in params]), os.path.getsize(filename))
+
+def parse_args():
+  import sys, argparse
+  parser = argparse.ArgumentParser(description='Int8/FP16 weight quantization for prototxt')
+  parser.add_argument('proto_name',
+                      help='prototxt filename')
+  parser.add_argument('param_path',
+                      help='directory of .bin files or packed parameter file')
+  parser.add_argument('output',
+                      help='output packed parameter file')
+  parser.add_argument('--mode', dest='mode',
+                      help='quantization mode: ' + ', '.join(quant_modes),
+                      default='int8', type=str, choices=quant_modes)
+  parser.add_argument('--min_size', dest='min_size',
+                      help='quantize weights having at least this number of elements',
+                      default=quant_min_size, type=int)
+  parser.add_argument('--images', dest='images',
+                      help='sample images for int8 calibration '
+                           '(default: no calibration, clip at max |W|)',
+                      default=[], type=str, nargs='*')
+  parser.add_argument('--max_rows', dest='max_rows',
+                      help='maximum number of sampled inputs for each fc layer',
+                      default=512, type=int)
+  if len(sys.argv) == 1:
+    parser.print_help()
+    sys.exit(1)
+  args = parser.parse_args()
+  return args
+
+if __name__ == "__main__":
+  args = parse_args()
+  params = read_params(args.param_path)
+  clips = None
+  if args.mode == 'int8' and len(args.images) > 0:
+    specs = load_spec(args.proto_name)
+    net = pvalib.create_empty_net()
+    net.contents.param_path = args.param_path
+    build_net(net, specs)
+    inputs = collect_inputs(net, specs, args.images, args.max_rows)
+    free_net(net)
+    clips, report = calibrate(inputs, params, args.min_size)
+    for name, error, calibrated_error in report:
+      print '{:32s} relative output error {:.5f} -> {:.5f} (calibrated)'.format( \
+            name, error, calibrated_error)
+  original_bytes, quantized_bytes = quantize_params(params, args.output, args.mode,
+                                                    args.min_size, clips)
+  print 'Parameters: {:.2f}MB -> {:.2f}MB ({:.1f}%)'.format( \
+        original_bytes / 1e6, quantized_bytes / 1e6,
+        100.0 * quantized_bytes / max(original_bytes, 1))
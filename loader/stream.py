@@ -0,0 +1,172 @@
+import os
+import glob
+import threading
+import Queue
+from pvanet import lib as pvalib
+from pvanet import decode_image, get_tensor_data
+
+image_exts = ['.jpg', '.jpeg', '.png', '.bmp']
+video_exts = ['.avi', '.mp4', '.mkv', '.mov', '.mpg', '.mpeg', '.wmv']
+
+def list_images(source):
+  # source: directory, glob pattern, or single image filename
+  if os.path.isdir(source):
+    names = [os.path.join(source, name) for name in sorted(os.listdir(source))]
+    return [name for name in names if os.path.splitext(name)[1].lower() in image_exts]
+  if any([c in source for c in '*?[']):
+    return sorted(glob.glob(source))
+  return [source]
+
+def is_video(source):
+  return os.path.isfile(source) and os.path.splitext(source)[1].lower() in video_exts
+
+def _resize(img, max_size):
+  # downscale such that longer side <= max_size
+  #   return (resized image, scale factor)
+  #   OpenCV is used if available, otherwise scipy.misc.imresize
+  if max_size is None or max(img.shape[:2]) <= max_size:
+    return (img, 1.0)
+  scale = float(max_size) / max(img.shape[:2])
+  height = int(round(img.shape[0] * scale))
+  width = int(round(img.shape[1] * scale))
+  try:
+    import cv2
+    return (cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA), scale)
+  except ImportError:
+    import scipy.misc
+    return (scipy.misc.imresize(img, (height, width)), scale)
+
+def _put(frames, item, stop):
+  # put item to frames unless stop is set
+  #   return False if stopped before item was put
+  while not stop.is_set():
+    try:
+      frames.put(item, timeout=0.1)
+      return True
+    except Queue.Full:
+      pass
+  return False
+
+def _acquire(slots, stop):
+  # wait for a free slot (see detect_stream) unless stop is set
+  slots.acquire()
+  return not stop.is_set()
+
+def _decode_images(names, frames, slots, stop, num_threads, max_size):
+  # decode images using num_threads threads
+  #   push (index, name, image, scale) to frames, then push None at the end
+  #   each image takes a slot before decoding, released by _ordered
+  tasks = Queue.Queue()
+  for index, name in enumerate(names):
+    tasks.put((index, name))
+
+  def run():
+    while _acquire(slots, stop):
+      try:
+        index, name = tasks.get_nowait()
+      except Queue.Empty:
+        slots.release()
+        break
+      scale = 1.0
+      try:
+        img = decode_image(name, bgr=False)
+        if img is not None:
+          img, scale = _resize(img, max_size)
+      except Exception as e:
+        print '[ERROR] Failed to decode {:s}: {:s}'.format(name, str(e))
+        img, scale = None, 1.0
+      if not _put(frames, (index, name, img, scale), stop):
+        break
+
+  workers = [threading.Thread(target=run) for i in range(num_threads)]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+  for worker in workers:
+    worker.join()
+  _put(frames, None, stop)
+
+def _decode_video(filename, frames, slots, stop, max_size):
+  # decode video frames sequentially
+  #   push (frame index, filename, image, scale) to frames,
+  #   then push None at the end
+  import cv2
+  capture = cv2.VideoCapture(filename)
+  index = 0
+  while _acquire(slots, stop):
+    success, img = capture.read()
+    if not success:
+      break
+    img, scale = _resize(img, max_size)
+    if not _put(frames, (index, filename, img, scale), stop):
+      break
+    index += 1
+  capture.release()
+  _put(frames, None, stop)
+
+def _ordered(frames, slots):
+  # yield items in frames in order of their indices
+  #   a slot is released after each item is consumed, so that at most
+  #   queue_size items are decoded ahead, including out-of-order items
+  #   waiting in pending
+  pending = {}
+  next_index = 0
+  while True:
+    item = frames.get()
+    if item is None:
+      break
+    pending[item[0]] = item
+    while pending.has_key(next_index):
+      yield pending.pop(next_index)
+      slots.release()
+      next_index += 1
+  for index in sorted(pending.keys()):
+    yield pending.pop(index)
+    slots.release()
+
+def detect_stream(net, source, num_threads=4, queue_size=16, max_size=None):
+  # detect objects in a directory, glob pattern, or video file
+  #   images (or frames) are decoded in background threads and buffered
+  #   in a queue of size queue_size, while network runs in caller's thread
+  #   max_size: if given, images are downscaled such that
+  #             longer side <= max_size before detection,
+  #             and output boxes are mapped back to original coordinates
+  #   yields a dict for each image (or frame) in order:
+  #     index, source, height, width, out (copy of 'out' tensor)
+  #   if the caller stops iterating early, decoder threads are stopped
+  #   when the generator is closed (or garbage-collected)
+  frames = Queue.Queue(maxsize=queue_size)
+  slots = threading.Semaphore(queue_size)
+  stop = threading.Event()
+  if is_video(source):
+    decoder = threading.Thread(target=_decode_video,
+                               args=(source, frames, slots, stop, max_size))
+  else:
+    decoder = threading.Thread(target=_decode_images,
+                               args=(list_images(source), frames, slots, stop,
+                                     num_threads, max_size))
+  decoder.daemon = True
+  decoder.start()
+
+  out_tensor = pvalib.get_tensor_by_name(net, 'out')
+  try:
+    for index, name, img, scale in _ordered(frames, slots):
+      result = {'index': index, 'source': name, 'out': None}
+      if img is None:
+        yield result
+        continue
+
+      pvalib.process_pvanet(net, img.ctypes.data, img.shape[0], img.shape[1], None, None, None)
+      out = get_tensor_data(out_tensor)[0].copy()
+      if scale != 1.0:
+        out[:, 1:5] /= scale
+      result['height'] = int(round(img.shape[0] / scale))
+      result['width'] = int(round(img.shape[1] / scale))
+      result['out'] = out
+      yield result
+  finally:
+    # wake up threads waiting for slots, and let them exit
+    stop.set()
+    for i in range(num_threads + 1):
+      slots.release()
+    decoder.join()
@@ -0,0 +1,175 @@
+# tests of loader modules, e.g., python -m unittest test_loader
+# (run in this directory, with libdlcpu.so in LD_LIBRARY_PATH)
+import os
+import sys
+import ast
+import ctypes
+import subprocess
+import unittest
+
+loader_dir = os.path.dirname(os.path.abspath(__file__))
+
+class ImportTest(unittest.TestCase):
+  # import-time budget, checked in fresh interpreters
+  budget = 0.5
+
+  def run_statement(self, statement):
+    # (elapsed time, whether libdlcpu.so is loaded, heavy modules loaded)
+    # after running statement
+    #   result is printed with repr on a marked line and parsed with
+    #   ast.literal_eval, so that other outputs or warnings are ignored
+    script = '\n'.join([
+        'import sys, time',
+        'start_time = time.time()',
+        statement,
+        'elapsed_time = time.time() - start_time',
+        "heavy = [name for name in ['scipy', 'google.protobuf', 'proto.caffe_pb2'] if name in sys.modules]",
+        "print '@result ' + repr((elapsed_time, loader.pvalib._lib is not None, heavy))"])
+    proc = subprocess.Popen([sys.executable, '-c', script], cwd=loader_dir,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    self.assertEqual(proc.returncode, 0, stderr)
+    results = [line for line in stdout.split('\n') if line.startswith('@result ')]
+    self.assertEqual(len(results), 1, stdout)
+    return ast.literal_eval(results[0][len('@result '):])
+
+  def test_import(self):
+    # "import loader" loads none of libdlcpu.so, SciPy, protobuf
+    elapsed_time, lib_loaded, heavy = self.run_statement('import loader')
+    self.assertLessEqual(elapsed_time, self.budget)
+    self.assertFalse(lib_loaded)
+    self.assertEqual(heavy, [])
+
+  def test_code_generation(self):
+    # code generation (load_pva33 without net) loads neither
+    # libdlcpu.so nor SciPy
+    elapsed_time, lib_loaded, heavy = self.run_statement('import loader; loader.load_pva33()')
+    self.assertFalse(lib_loaded)
+    self.assertNotIn('scipy', heavy)
+
+class DecodeTest(unittest.TestCase):
+  # encoded images given as str, bytearray and memoryview
+  def encoded(self):
+    from PIL import Image
+    from io import BytesIO
+    import numpy as np
+    self.img = (np.arange(4 * 6 * 3) * 11 % 256).astype(np.uint8).reshape((4, 6, 3))
+    f = BytesIO()
+    Image.fromarray(self.img).save(f, 'PNG')
+    data = f.getvalue()
+    return [data, bytearray(data), memoryview(data), memoryview(bytearray(data))]
+
+  def test_opencv(self):
+    # encoded bytes reach cv2.imdecode as uint8 array
+    import types
+    import numpy as np
+    import pvanet
+    calls = []
+    def imdecode(buf, flags):
+      calls.append(buf)
+      return self.img[:, :, ::-1].copy()
+    cv2 = types.ModuleType('cv2')
+    cv2.IMREAD_COLOR = 1
+    cv2.imdecode = imdecode
+    saved = sys.modules.get('cv2')
+    sys.modules['cv2'] = cv2
+    try:
+      for image in self.encoded():
+        img = pvanet.decode_image(image)
+        self.assertTrue((img == self.img[:, :, ::-1]).all(), type(image))
+        self.assertEqual(calls[-1].dtype, np.uint8)
+        self.assertEqual(calls[-1].tostring(), str(self.encoded()[0]))
+    finally:
+      if saved is None:
+        del sys.modules['cv2']
+      else:
+        sys.modules['cv2'] = saved
+
+  def test_pil(self):
+    # PIL is used only without OpenCV
+    import pvanet
+    try:
+      import cv2
+      self.skipTest('OpenCV is installed')
+    except ImportError:
+      pass
+    for image in self.encoded():
+      img = pvanet.decode_image(image)
+      self.assertTrue((img == self.img[:, :, ::-1]).all(), type(image))
+
+class DetectionRequestTest(unittest.TestCase):
+  def test_timeout(self):
+    # a timeout is told apart from a missing result
+    import pvanet
+    request = pvanet.DetectionRequest(None)
+    self.assertRaises(pvanet.DetectionTimeout, request.wait, 0.01)
+    request.done.set()
+    self.assertIsNone(request.wait(0.01))
+
+class FreeNetTest(unittest.TestCase):
+  def test_release(self):
+    # free_net drops image buffers and tensor views kept for the net
+    # (9.0.0lite with random parameters)
+    import numpy as np
+    import pvanet
+    import loader
+    net = pvanet.lib.create_empty_net()
+    net.contents.param_path = '/nonexistent'
+    loader.load_pva33(net=net)
+    address = ctypes.addressof(net.contents)
+    end = address + ctypes.sizeof(net.contents)
+    def num_views():
+      return len([key for key in pvanet._tensor_views if address <= key < end])
+    img = np.zeros((100, 120, 3), dtype=np.uint8)
+    pvanet.detect(net, img)
+    pvanet.get_tensor_data(pvanet.lib.get_tensor_by_name(net, 'out'))
+    self.assertIn((address, 0), pvanet._image_buffers)
+    self.assertEqual(num_views(), 1)
+    pvanet.free_net(net)
+    self.assertNotIn((address, 0), pvanet._image_buffers)
+    self.assertEqual(num_views(), 0)
+    self.assertNotIn(address, pvanet._mapped_arrays)
+
+class CostTest(unittest.TestCase):
+  # static shape inference on the default input, i.e., the largest one
+  # resized by image layer, and on an input the runtime never sees
+  proto_names = ['9.0.0lite.pt',
+                 '../pvanet/9.0.0_mod1_tuned/9.0.0_mod1.new.21cls.pt']
+
+  def test_default_input(self):
+    import cost
+    from loader import load_proto
+    for proto_name in self.proto_names:
+      records = cost.infer_cost(load_proto(os.path.join(loader_dir, proto_name)))
+      self.assertGreater(cost.summarize(records)['macs'], 0)
+
+  def test_shape_mismatch(self):
+    # 600 x 1000 is not a multiple of 32, so concat inputs disagree
+    import cost
+    from loader import load_proto
+    proto = load_proto(os.path.join(loader_dir, self.proto_names[1]))
+    self.assertRaises(ValueError, cost.infer_cost, proto, 600, 1000)
+
+class ScaledSizeTest(unittest.TestCase):
+  # scaled_size in Python vs. compute_scaled_size in libdlcpu.so,
+  # which must agree exactly, since cost estimates rely on the resized
+  # input size
+  def check(self, raw_sizes, input_size, unit_size):
+    import pvanet
+    for raw_h, raw_w in raw_sizes:
+      self.assertEqual(pvanet.scaled_size(raw_h, raw_w, input_size, unit_size),
+                       pvanet.resized_size(raw_h, raw_w, input_size, unit_size),
+                       (raw_h, raw_w, input_size, unit_size))
+
+  def test_grid(self):
+    sides = range(1, 64) + range(64, 2049, 11)
+    raw_sizes = [(raw_h, raw_w) for raw_h in sides for raw_w in sides]
+    for input_size, unit_size in [(600, 32), (480, 32), (192, 16), (1000, 32)]:
+      self.check(raw_sizes, input_size, unit_size)
+
+  def test_rounding_cases(self):
+    # sizes at which double-precision arithmetic gives different results
+    self.check([(104, 65), (468, 975), (65, 104), (975, 468)], 600, 32)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -47,6 +47,7 @@ def inceptions():
   #proto_src = 'faster_rcnn_train_test.pt'
   #proto_dest = 'faster_rcnn_train_test_comb.pt'
   #model = 'pva9.0.0_fixed.caffemodel'
+  pass
 
 def inception(x):
   y = {}
@@ -209,31 +210,76 @@ def track(x0):
   plt.plot(fx.reshape(200,5).mean(axis=1))
   plt.show()
 
-def layer_img(img, layer):
+def patch_matrix(img, x1, y1, patch_height=91, patch_width=91):
+  # patches starting at (x1[n], y1[n]), zero-padded outside the image,
+  # same as crop_patch
+  #   return n x (patch_height * patch_width * 3) float32 matrix
+  padded = np.zeros((img.shape[0] + patch_height, img.shape[1] + patch_width, 3), dtype=np.float32)
+  padded[:img.shape[0], :img.shape[1], :] = img[:, :, :3]
+  ys = np.asarray(y1).reshape((-1, 1, 1)) + np.arange(patch_height).reshape((1, -1, 1))
+  xs = np.asarray(x1).reshape((-1, 1, 1)) + np.arange(patch_width).reshape((1, 1, -1))
+  return padded[ys, xs].reshape((ys.shape[0], -1))
+
+def layer_img_sum(img, layer, sums=None, weights=None, patch_height=91, patch_width=91,
+                  block_size=256):
+  # weighted sum of patches for all channels of a layer output,
+  # weights = positive activations (see layer_img)
+  #   (channels x positions) weights x (positions x patch) matrix product,
+  #   over blocks of block_size positions to bound memory
+  #   positions where no channel is positive are skipped
+  #   sums, weights: accumulators from previous images, or None
+  #   return (sums: channels x patch_height x patch_width x 3,
+  #           weights: channels), in double precision
   scale_h = img.shape[0] / layer.shape[1]
   scale_w = img.shape[1] / layer.shape[2]
-  patch_height = 91
-  patch_width = 91
-  layer_flat = layer.reshape((layer.shape[0], -1))
-  mean_patches = np.zeros((layer.shape[0], patch_height, patch_width, 3), dtype=np.uint8)
-  mean_patch = np.zeros((patch_height, patch_width, 3), dtype=np.double)
-  weight = np.zeros((1,), dtype=np.double)
-  for ch in range(layer.shape[0]):
-    weight[0] = 0
-    for i, val in enumerate(layer_flat[ch]):
-      if val > 0:
-            x_ctr = (i % layer.shape[2]) * scale_w
-            y_ctr = (i / layer.shape[2]) * scale_h
-            x1 = min(max(0, x_ctr), img.shape[1])
-            y1 = min(max(0, y_ctr), img.shape[0])
-            x2 = min(max(0, x_ctr + patch_width), img.shape[1])
-            y2 = min(max(0, y_ctr + patch_height), img.shape[0])
-            w = x2 - x1
-            h = y2 - y1
-            mean_patch[:h, :w, :] += val * img[y1:y2, x1:x2, :]
-            weight[0] += val
-    mean_patches[ch] = mean_patch / weight[0]
-  return mean_patches
+  layer_flat = np.maximum(layer.reshape((layer.shape[0], -1)), 0).astype(np.float32)
+  if sums is None:
+    sums = np.zeros((layer.shape[0], patch_height * patch_width * 3), dtype=np.double)
+    weights = np.zeros((layer.shape[0],), dtype=np.double)
+  sums = sums.reshape((layer.shape[0], -1))
+
+  active = np.nonzero(layer_flat.max(axis=0) > 0)[0]
+  for start in range(0, len(active), block_size):
+    idx = active[start:start + block_size]
+    patches = patch_matrix(img, (idx % layer.shape[2]) * scale_w, (idx / layer.shape[2]) * scale_h,
+                           patch_height, patch_width)
+    sums += np.dot(layer_flat[:, idx], patches)
+  weights += layer_flat.sum(axis=1)
+  return (sums.reshape((layer.shape[0], patch_height, patch_width, 3)), weights)
+
+def layer_img(img, layer, patch_height=91, patch_width=91):
+  # activation-weighted average of patches for each channel of a layer
+  # output (channels x height x width) of an image
+  return mean_patches(*layer_img_sum(img, layer, patch_height=patch_height,
+                                     patch_width=patch_width))
+
+def layer_imgs(pairs, patch_height=91, patch_width=91):
+  # layer_img over many images, accumulated in a streaming fashion
+  #   pairs: iterable of (image, layer output), e.g., a generator
+  sums = None
+  weights = None
+  for img, layer in pairs:
+    sums, weights = layer_img_sum(img, layer, sums, weights, patch_height, patch_width)
+  return mean_patches(sums, weights)
+
+def mean_patches(sums, weights):
+  # uint8 patches from accumulators (see layer_img_sum)
+  #   channels never activated give zero patches
+  mean = sums / np.maximum(weights, np.finfo(np.double).tiny).reshape((-1, 1, 1, 1))
+  return np.clip(np.round(mean), 0, 255).astype(np.uint8)
+
+def crop_patch(img, x_ctr, y_ctr, patch_height=91, patch_width=91):
+  # patch_height x patch_width patch starting at (x_ctr, y_ctr),
+  # zero-padded outside the image
+  x1 = min(max(0, x_ctr), img.shape[1])
+  y1 = min(max(0, y_ctr), img.shape[0])
+  x2 = min(max(0, x_ctr + patch_width), img.shape[1])
+  y2 = min(max(0, y_ctr + patch_height), img.shape[0])
+  w = x2 - x1
+  h = y2 - y1
+  img_sub = np.zeros((patch_height, patch_width, 3), dtype=np.uint8)
+  img_sub[:h, :w, :] = img[y1:y2, x1:x2, :3]
+  return img_sub
 
 def layer_topk(img, layer, ch, num_top=64):
   scale_h = img.shape[0] / layer.shape[1]
@@ -247,26 +293,139 @@ def layer_topk(img, layer, ch, num_top=64):
   for i, idx in enumerate(topk):
       x_ctr = (idx % layer.shape[2]) * scale_w
       y_ctr = (idx / layer.shape[2]) * scale_h
-      x1 = min(max(0, x_ctr), img.shape[1])
-      y1 = min(max(0, y_ctr), img.shape[0])
-      x2 = min(max(0, x_ctr + patch_width), img.shape[1])
-      y2 = min(max(0, y_ctr + patch_height), img.shape[0])
-      print '{:d}: ({:f},{:f}), ({:f},{:f}), score = {:f}'.format(idx, x1, y1, x2, y2, scores[i])
-      w = x2 - x1
-      h = y2 - y1
+      print '{:d}: ({:f},{:f}), score = {:f}'.format(idx, x_ctr, y_ctr, scores[i])
       plt.subplot(val, val, i + 1)
-      img_sub = np.zeros((patch_height, patch_width, 3), dtype=np.uint8)
-      img_sub[:h, :w, :] = img[y1:y2, x1:x2, :]
-      if h < patch_height:
-        img_sub[h:, :, :] = 0
-      if w < patch_width:
-        img_sub[:, w:, :] = 0
+      img_sub = crop_patch(img, x_ctr, y_ctr, patch_height, patch_width)
       fig = plt.imshow(img_sub)
       plt.axis=('off')
       fig.axes.get_xaxis().set_visible(False)
       fig.axes.get_yaxis().set_visible(False)
   plt.show()
 
+# dataset-scale top-K activation mining
+#   mine_topk streams images through a caffe net in batches over a process
+#   pool, and keeps a bounded min-heap of the top-K activations for every
+#   channel of a layer, with their source image and patch coordinates
+#   images are read again only at the end (topk_patches) to crop winners,
+#   so memory is O(channels x K) regardless of number of images
+mean_bgr = [103.939, 116.779, 123.68]
+_topk_net = None
+_topk_layer = None
+
+def image_blob(img):
+  # RGB image (H x W x 3, e.g., by load_image) -> 1 x 3 x H x W BGR blob
+  if len(img.shape) == 2:
+    img = np.tile(img.reshape(img.shape + (1,)), (1, 1, 3))
+  blob = img[:, :, 2::-1].astype(np.float32) - np.array(mean_bgr, dtype=np.float32)
+  return blob.transpose((2, 0, 1)).reshape((1, 3) + img.shape[:2])
+
+def layer_activations(net, img, im_info, layer_name):
+  # layer output (channels x height x width) for an image
+  data = image_blob(img)
+  inputs = {'data': data}
+  net.blobs['data'].reshape(*(data.shape))
+  if 'im_info' in net.blobs:
+    inputs['im_info'] = im_info
+    net.blobs['im_info'].reshape(*(im_info.shape))
+  net.forward(end=layer_name, **inputs)
+  return net.blobs[layer_name].data[0]
+
+def image_topk(img, layer, num_top=64):
+  # top-K activations of each channel of a layer output for an image
+  #   return (scores, x1, y1): channels x K arrays,
+  #   x1, y1: patch coordinates in img, same as layer_topk
+  scale_h = img.shape[0] / layer.shape[1]
+  scale_w = img.shape[1] / layer.shape[2]
+  layer_flat = layer.reshape((layer.shape[0], -1))
+  num_top = min(num_top, layer_flat.shape[1])
+  topk = np.argpartition(-layer_flat, num_top - 1, axis=1)[:, :num_top]
+  scores = layer_flat[np.arange(layer_flat.shape[0]).reshape((-1, 1)), topk]
+  return (scores, (topk % layer.shape[2]) * scale_w, (topk / layer.shape[2]) * scale_h)
+
+def _init_topk_worker(proto, model, layer_name):
+  # create a net for each worker process
+  import caffe
+  global _topk_net, _topk_layer
+  caffe.set_mode_cpu()
+  _topk_net = caffe.Net(proto, model, caffe.TEST)
+  _topk_layer = layer_name
+
+def _topk_worker(task):
+  # task: (index of the first image, image filenames, num_top)
+  #   return [(image index, scores, x1, y1)] for each image, see image_topk
+  start, filenames, num_top = task
+  results = []
+  for i, filename in enumerate(filenames):
+    img, im_info = load_image(filename)
+    layer = layer_activations(_topk_net, img, im_info, _topk_layer)
+    results.append((start + i,) + image_topk(img, layer, num_top))
+  return results
+
+def mine_topk(proto, model, layer_name, filenames, num_top=64, num_workers=4, batch_size=8):
+  # top-K activations of each channel of a layer over images
+  #   each worker process builds its own net and handles batch_size images
+  #   per task, and only its per-image top-K candidates are sent back
+  #   return list of [(score, image filename, x1, y1)] for each channel,
+  #   sorted in descending order of score
+  import heapq
+  tasks = [(start, filenames[start:start + batch_size], num_top) \
+           for start in range(0, len(filenames), batch_size)]
+  if num_workers > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(num_workers, _init_topk_worker, (proto, model, layer_name))
+    batches = pool.imap_unordered(_topk_worker, tasks)
+  else:
+    pool = None
+    _init_topk_worker(proto, model, layer_name)
+    batches = (_topk_worker(task) for task in tasks)
+
+  heaps = None
+  count = 0
+  for results in batches:
+    for index, scores, x1, y1 in results:
+      if heaps is None:
+        heaps = [[] for ch in range(scores.shape[0])]
+        thresholds = np.empty((scores.shape[0],), dtype=np.float32)
+        thresholds[:] = -np.inf
+      # only candidates beating the K-th best score so far enter the heaps
+      for ch, k in zip(*np.nonzero(scores > thresholds.reshape((-1, 1)))):
+        item = (float(scores[ch, k]), index, int(x1[ch, k]), int(y1[ch, k]))
+        if len(heaps[ch]) < num_top:
+          heapq.heappush(heaps[ch], item)
+        else:
+          heapq.heappushpop(heaps[ch], item)
+        if len(heaps[ch]) == num_top:
+          thresholds[ch] = heaps[ch][0][0]
+      count += 1
+    print 'Processed {:d}/{:d} images'.format(count, len(filenames))
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  if heaps is None:
+    return []
+  return [[(score, filenames[index], x1, y1) for score, index, x1, y1 in sorted(heap, reverse=True)] \
+          for heap in heaps]
+
+def topk_patches(topk, channels=None, patch_height=91, patch_width=91):
+  # crop patches of mined activations (see mine_topk)
+  #   each image is read once for all requested channels
+  #   return dict: channel -> K x patch_height x patch_width x 3 array,
+  #   which can be shown by plot_imgs
+  if channels is None:
+    channels = range(len(topk))
+  requests = {}
+  for ch in channels:
+    for k, (score, filename, x1, y1) in enumerate(topk[ch]):
+      requests.setdefault(filename, []).append((ch, k, x1, y1))
+  patches = dict([(ch, np.zeros((len(topk[ch]), patch_height, patch_width, 3), dtype=np.uint8)) \
+                  for ch in channels])
+  for filename, items in requests.items():
+    img, im_info = load_image(filename)
+    for ch, k, x1, y1 in items:
+      patches[ch][k] = crop_patch(img, x1, y1, patch_height, patch_width)
+  return patches
+
 def plot_imgs(imgs):
   val = np.ceil(np.sqrt(imgs.shape[0]))
   for i in range(imgs.shape[0]):